@@ -4,7 +4,13 @@ ESP32 device configuration
 Keys are Unique ID for the board; values are dictionaries matching the
 keyword arguments of the ``PrometheusDevice`` class in ``promdevice.py``.
 Within the ``pins`` list, values are dictionaries matching the keyword arguments
-of the ``GpioSensor`` class in ``promdevice.py``.
+of the sensor class named by their optional ``type`` key (see ``SENSOR_TYPES``
+in ``promdevice.py``): ``gpio`` (the default) for the ``GpioSensor`` class in
+``promdevice.py`` or ``touch`` for the ``TouchSensor`` class in
+``touchsensor.py``. Any pin may also set ``webhook`` to a URL that is sent
+a JSON ``POST`` on each of its transitions. Within the optional
+``composites`` list, values are dictionaries matching the keyword arguments of
+the ``CompositeSensor`` class in ``promdevice.py`` (other than ``sensors``).
 """
 
 DEVICE_CONFIG = {
@@ -29,6 +35,12 @@ DEVICE_CONFIG = {
                 'pull_up': True,
                 'on_value': 0
             }
+        ],
+        'composites': [
+            {
+                'name': 'secure',
+                'expr': 'latch and leftmag and rightmag'
+            }
         ]
     },
     '0cb815c53148': {
@@ -0,0 +1,96 @@
+from array import array
+from typing import List
+
+from utils import unix_time_ms
+
+
+class EventRing:
+
+    def __init__(self, sensors: List, capacity: int = 128):
+        """
+        Fixed-capacity ring buffer of committed sensor transitions. Events
+        are stored column-wise in preallocated arrays, so recording one does
+        not allocate per-event objects. Every event gets a monotonically
+        increasing sequence number, which clients use as a cursor.
+
+        :param sensors: List of Sensors to record transitions for; events
+          refer to sensors by their index in this list
+        :param capacity: Maximum number of events retained; older events are
+          overwritten
+        """
+        self.sensors: List = sensors
+        self.capacity: int = capacity
+        self._sensor: bytearray = bytearray(capacity)
+        self._state: bytearray = bytearray(capacity)
+        self._time_ms: array = array('q', (0 for _ in range(capacity)))
+        #: Sequence number that the next recorded event will get
+        self.next_seq: int = 0
+        #: Sequence number of the first event recorded since boot
+        self.start_seq: int = 0
+        for idx, sensor in enumerate(sensors):
+            # record before notifying dependent composites, so that a cause
+            # always gets a lower sequence number than its effects
+            sensor.listeners.insert(
+                0, lambda s, idx=idx: self.record(idx, s.input_state)
+            )
+
+    @property
+    def first_seq(self) -> int:
+        """Sequence number of the oldest event still in the buffer."""
+        return max(self.start_seq, self.next_seq - self.capacity)
+
+    @property
+    def overwritten(self) -> int:
+        """Number of events overwritten since boot."""
+        return self.first_seq - self.start_seq
+
+    def restore_seq(self, seq: int):
+        """
+        Continue numbering events from ``seq``, i.e. the sequence number saved
+        before a reboot, so that client cursors stay valid. Must be called
+        while the buffer is still empty.
+        """
+        if self.next_seq == self.start_seq:
+            self.next_seq = self.start_seq = seq
+
+    def adjust_time(self, step_ms: int):
+        """
+        Shift the timestamps of buffered events by ``step_ms`` milliseconds,
+        i.e. when the clock is first set after boot.
+        """
+        for seq in range(self.first_seq, self.next_seq):
+            self._time_ms[seq % self.capacity] += step_ms
+
+    def record(self, sensor_idx: int, state: int):
+        i = self.next_seq % self.capacity
+        self._sensor[i] = sensor_idx
+        self._state[i] = state
+        self._time_ms[i] = unix_time_ms()
+        self.next_seq += 1
+
+    def iter_since(self, since: int):
+        """
+        Generator yielding ``(seq, sensor, state, unix_ms)`` for every buffered
+        event with a sequence number of at least ``since``.
+        """
+        for seq in range(max(since, self.first_seq), self.next_seq):
+            i = seq % self.capacity
+            yield (
+                seq, self.sensors[self._sensor[i]], self._state[i],
+                self._time_ms[i]
+            )
+
+    def render_since(self, since: int) -> str:
+        """
+        Return all buffered events with a sequence number of at least
+        ``since`` as newline-delimited ``<seq> <pin_name> <state> <unix_ms>``
+        records. The first line is a ``# next=<seq> missed=<count>`` header,
+        where ``next`` is the cursor to pass next time and ``missed`` is how
+        many requested events were already overwritten.
+        """
+        end = self.next_seq
+        missed = max(0, self.first_seq - since)
+        lines = ['# next=%d missed=%d' % (end, missed)]
+        for seq, sensor, state, ts in self.iter_since(since):
+            lines.append('%d %s %d %d' % (seq, sensor.name, state, ts))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,111 @@
+from time import ticks_ms, ticks_diff
+from typing import List
+
+from events import EventRing
+from microdot import Response, MUTED_SOCKET_ERRORS
+from utils import logger
+
+
+class EventStreamHub:
+    """
+    Streams transitions from an ``EventRing`` to any number of Server-Sent
+    Events subscribers. Subscriber connections are detached from microdot and
+    serviced from its idle loop, so they need no thread of their own and do
+    not hold up other requests.
+    """
+
+    #: Maximum number of concurrent subscribers
+    max_subscribers: int = 4
+
+    #: Seconds between heartbeat comments on an otherwise idle stream
+    heartbeat_interval: int = 15
+
+    #: Timeout, in seconds, for writes to a subscriber (socket writes, or in
+    #: async mode flushes of the stream writer); subscribers that cannot
+    #: keep up, including those a write could only partly be sent to, are
+    #: disconnected
+    write_timeout: float = 0.2
+
+    HEADERS: bytes = (
+        b'HTTP/1.0 200 OK\r\n'
+        b'Content-Type: text/event-stream\r\n'
+        b'Cache-Control: no-cache\r\n'
+        b'\r\n'
+    )
+
+    def __init__(self, ring: EventRing):
+        self.ring: EventRing = ring
+        #: List of [stream, sock, cursor, ticks_ms of last write]
+        self.subscribers: List[List] = []
+
+    def handle_request(self, req):
+        if len(self.subscribers) >= self.max_subscribers:
+            return 'Too many subscribers', 503, {'Retry-After': '5'}
+        cursor = self.ring.next_seq
+        last_id = req.headers.get('Last-Event-ID')
+        if last_id is not None:
+            try:
+                cursor = int(last_id) + 1
+            except ValueError:
+                pass
+        stream = req.detach()
+        if hasattr(req.sock, 'settimeout'):
+            req.sock.settimeout(self.write_timeout)
+        sub = [stream, req.sock, cursor, ticks_ms()]
+        if self._write(sub, self.HEADERS):
+            logger.debug('SSE subscriber connected from %s', req.client_addr)
+            self.subscribers.append(sub)
+        return Response.already_handled
+
+    def _write(self, sub: List, data: bytes) -> bool:
+        try:
+            n = sub[0].write(data)
+            if hasattr(sub[0], 'flush'):
+                sub[0].flush()
+            if isinstance(n, int) and n < len(data):
+                # the rest of the event would be lost; the client resumes
+                # from the last complete one when it reconnects
+                raise OSError('short write (%d of %d bytes)' % (n, len(data)))
+        except OSError as exc:
+            if exc.errno not in MUTED_SOCKET_ERRORS:
+                logger.debug('SSE subscriber write failed: %s', exc)
+            self._close(sub)
+            return False
+        sub[3] = ticks_ms()
+        return True
+
+    def _close(self, sub: List):
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+        try:
+            sub[0].close()
+            if sub[1] is not sub[0]:
+                sub[1].close()
+        except OSError:
+            pass
+
+    def poll(self):
+        """
+        Send any new events, or a heartbeat if due, to every subscriber.
+        Intended to be registered as a microdot idle handler.
+        """
+        if not self.subscribers:
+            return
+        ring = self.ring
+        now = ticks_ms()
+        for sub in list(self.subscribers):
+            if sub[2] < ring.next_seq:
+                parts = []
+                if sub[2] < ring.first_seq:
+                    parts.append(
+                        ': missed %d events\n\n' % (ring.first_seq - sub[2])
+                    )
+                for seq, sensor, state, ts in ring.iter_since(sub[2]):
+                    parts.append((
+                        'id: %d\nevent: transition\ndata: {"pin": "%s", '
+                        '"state": %d, "time_ms": %d}\n\n'
+                    ) % (seq, sensor.name, state, ts))
+                    sub[2] = seq + 1
+                self._write(sub, ''.join(parts).encode())
+            elif ticks_diff(now, sub[3]) >= self.heartbeat_interval * 1000:
+                self._write(sub, b': heartbeat\n\n')
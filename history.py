@@ -0,0 +1,239 @@
+from array import array
+from typing import List, Dict
+
+from utils import unix_time_ms
+
+
+class HistoryBuffer:
+    """
+    Compact on-device time series of sensor state, for backfilling Prometheus
+    after the board was unreachable. Everything is stored in one preallocated
+    ``bytearray`` as variable-length records, each starting with a header
+    byte followed by the LEB128-encoded milliseconds since the previous
+    record:
+
+    * transition: header ``idx << 1 | state`` (high bit clear)
+    * snapshot: header ``0x80``, then one byte per sensor holding the state in
+      the high bit and the percentage of the interval the sensor was on in
+      the low 7 bits
+
+    When the buffer is full, or records are older than the retention period,
+    the oldest records are dropped.
+    """
+
+    CONTENT_TYPE: str = \
+        'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    #: Number of lines ``render()`` joins into each chunk it yields
+    chunk_lines: int = 16
+
+    def __init__(
+        self, sensors: List, size: int = 4096, retention: int = 86400,
+        interval: int = 300
+    ):
+        """
+        :param sensors: List of Sensors to record; at most 64
+        :param size: Memory budget for the buffer, in bytes
+        :param retention: Maximum age of retained records, in seconds
+        :param interval: Seconds between snapshot records
+        """
+        assert len(sensors) <= 64, "HistoryBuffer supports at most 64 sensors"
+        self.sensors: List = sensors
+        self.size: int = size
+        self.retention_ms: int = retention * 1000
+        self.interval_ms: int = interval * 1000
+        self.buf: bytearray = bytearray(size)
+        self._mv: memoryview = memoryview(self.buf)
+        #: Number of bytes of ``buf`` in use
+        self.used: int = 0
+        #: Timestamp that the first record's delta is relative to
+        self.base_ms: int = unix_time_ms()
+        #: Timestamp of the last record
+        self.last_ms: int = self.base_ms
+        #: Number of records dropped to stay within budget or retention
+        self.dropped: int = 0
+        n = len(sensors)
+        self._on_ms: array = array('l', (0 for _ in range(n)))
+        self._since_ms: array = array('q', (self.base_ms for _ in range(n)))
+        self._snapshot_ms: int = self.base_ms
+        for idx, sensor in enumerate(sensors):
+            sensor.listeners.append(
+                lambda s, idx=idx: self.record_transition(idx, s.input_state)
+            )
+
+    def _append(self, header: int, now: int, payload: bytes = b''):
+        delta = max(0, now - self.last_ms)
+        rec = bytearray([header])
+        while True:
+            b = delta & 0x7f
+            delta >>= 7
+            if delta:
+                rec.append(b | 0x80)
+            else:
+                rec.append(b)
+                break
+        rec.extend(payload)
+        if len(rec) > self.size:
+            return
+        self._expire(now, len(rec))
+        self._mv[self.used:self.used + len(rec)] = rec
+        self.used += len(rec)
+        self.last_ms = now
+
+    def _record_len(self, pos: int, buf=None):
+        """
+        Return (length, delta_ms) of the record at ``pos`` of ``buf``, or of
+        the buffer itself.
+        """
+        if buf is None:
+            buf = self.buf
+        header = buf[pos]
+        i = pos + 1
+        delta = 0
+        shift = 0
+        while True:
+            b = buf[i]
+            delta |= (b & 0x7f) << shift
+            shift += 7
+            i += 1
+            if not b & 0x80:
+                break
+        if header & 0x80:
+            i += len(self.sensors)
+        return i - pos, delta
+
+    def _expire(self, now: int, need: int):
+        """
+        Drop the oldest records until ``need`` bytes are free and no record
+        is older than the retention period.
+        """
+        pos = 0
+        base = self.base_ms
+        while pos < self.used:
+            length, delta = self._record_len(pos)
+            if (
+                self.used - pos + need <= self.size and
+                now - (base + delta) <= self.retention_ms
+            ):
+                break
+            pos += length
+            base += delta
+            self.dropped += 1
+        if pos:
+            self._mv[0:self.used - pos] = self._mv[pos:self.used]
+            self.used -= pos
+            self.base_ms = base
+
+    def adjust_time(self, step_ms: int):
+        """
+        Shift every timestamp by ``step_ms`` milliseconds, i.e. when the clock
+        is first set after boot. Records are stored relative to ``base_ms``,
+        so they move with it.
+        """
+        self.base_ms += step_ms
+        self.last_ms += step_ms
+        self._snapshot_ms += step_ms
+        for idx in range(len(self._since_ms)):
+            self._since_ms[idx] += step_ms
+
+    def record_transition(self, idx: int, state: int):
+        now = unix_time_ms()
+        if state == 0:
+            # the sensor was on until now
+            self._on_ms[idx] += now - self._since_ms[idx]
+        self._since_ms[idx] = now
+        self._append(idx << 1 | (state & 1), now)
+
+    def poll(self):
+        """
+        Record a snapshot if one is due. Intended to be registered as a
+        microdot idle handler.
+        """
+        now = unix_time_ms()
+        elapsed = now - self._snapshot_ms
+        if elapsed < self.interval_ms:
+            return
+        payload = bytearray(len(self.sensors))
+        for idx, sensor in enumerate(self.sensors):
+            on_ms = self._on_ms[idx]
+            if sensor.input_state == 1:
+                on_ms += now - self._since_ms[idx]
+                payload[idx] = 0x80
+            self._on_ms[idx] = 0
+            self._since_ms[idx] = now
+            payload[idx] |= min(100, on_ms * 100 // elapsed)
+        self._snapshot_ms = now
+        self._append(0x80, now, payload)
+
+    def _samples(self, idx: int, buf: bytes, base_ms: int):
+        """
+        Generator yielding ``(unix_ms, state, on_percent)`` for every record
+        in ``buf`` (a copy of the used part of the buffer, whose first
+        record is relative to ``base_ms``) concerning sensor ``idx``, oldest
+        first; ``on_percent`` is None for transitions.
+        """
+        pos = 0
+        ts = base_ms
+        n = len(self.sensors)
+        while pos < len(buf):
+            length, delta = self._record_len(pos, buf)
+            ts += delta
+            header = buf[pos]
+            if header & 0x80:
+                b = buf[pos + length - n + idx]
+                yield ts, b >> 7, b & 0x7f
+            elif header >> 1 == idx:
+                yield ts, header & 1, None
+            pos += length
+
+    def render(self, labels: Dict):
+        """
+        Generator yielding the whole buffer as OpenMetrics text with explicit
+        timestamps, suitable for ``promtool tsdb create-blocks-from
+        openmetrics``, in chunks of ``chunk_lines`` lines. A full buffer
+        renders to many times its size, so it is never rendered as a whole.
+
+        :param labels: Extra labels to add to every sample
+        """
+        chunk = []
+        for line in self._lines(labels):
+            chunk.append(line)
+            if len(chunk) >= self.chunk_lines:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append('# EOF\n')
+        yield ''.join(chunk)
+
+    def _lines(self, labels: Dict):
+        # render a copy, as records are added (and the oldest dropped) by
+        # transitions while the response is being sent
+        buf = bytes(self._mv[:self.used])
+        base_ms = self.base_ms
+        lbls = []
+        for sensor in self.sensors:
+            lbl = dict(labels)
+            lbl.update(sensor.labels())
+            lbls.append('{' + ','.join([
+                f'{k}="{v}"' for k, v in sorted(lbl.items())
+            ]) + '}')
+        yield '# HELP gpio_pin_is_on Whether the GPIO pin is on (1) or off ' \
+            '(0)\n# TYPE gpio_pin_is_on gauge\n'
+        for idx, lbl in enumerate(lbls):
+            pending = None
+            for ts, state, _ in self._samples(idx, buf, base_ms):
+                t = '%d.%03d' % (ts // 1000, ts % 1000)
+                # samples must have unique timestamps; when records share a
+                # millisecond, the later one wins
+                if pending and pending[0] != t:
+                    yield f'gpio_pin_is_on{lbl} {pending[1]} {pending[0]}\n'
+                pending = (t, state)
+            if pending:
+                yield f'gpio_pin_is_on{lbl} {pending[1]} {pending[0]}\n'
+        yield '# HELP gpio_pin_on_ratio Fraction of the snapshot interval ' \
+            'the pin was on\n# TYPE gpio_pin_on_ratio gauge\n'
+        for idx, lbl in enumerate(lbls):
+            for ts, _, pct in self._samples(idx, buf, base_ms):
+                if pct is not None:
+                    yield 'gpio_pin_on_ratio%s %s %d.%03d\n' % (
+                        lbl, pct / 100, ts // 1000, ts % 1000
+                    )
@@ -0,0 +1,247 @@
+import errno
+from time import ticks_ms, ticks_diff
+from typing import Dict, Optional, Tuple
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+from utils import logger
+
+#: errno values of a non-blocking socket operation that would have blocked
+_WOULD_BLOCK = (errno.EAGAIN, errno.EINPROGRESS)
+
+
+def parse_response(
+    buf: bytes, eof: bool = False
+) -> Optional[Tuple[int, bytes, bool]]:
+    """
+    Parse a complete HTTP response from ``buf``.
+
+    :param buf: Bytes received so far
+    :param eof: Whether the server has closed the connection, which ends a
+      response without framing (no ``Content-Length`` and not chunked)
+    :return: 3-tuple of the status code, body and whether the connection
+      can be kept alive, or None if ``buf`` does not hold the whole response
+      yet
+    """
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+    lines = buf[:end].split(b'\r\n')
+    status = int(lines[0].split(None, 2)[1])
+    length = None
+    chunked = False
+    keep_alive = not lines[0].startswith(b'HTTP/1.0')
+    for line in lines[1:]:
+        name, _, value = line.decode().partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value.lower() != 'close'
+        elif name == 'transfer-encoding':
+            chunked = value.lower() == 'chunked'
+    pos = end + 4
+    if status in (204, 304):
+        return status, b'', keep_alive
+    if chunked:
+        body = b''
+        while True:
+            eol = buf.find(b'\r\n', pos)
+            if eol < 0:
+                return None
+            size = int(buf[pos:eol].split(b';')[0], 16)
+            pos = eol + 2
+            if len(buf) < pos + size + 2:
+                return None
+            body += buf[pos:pos + size]
+            pos += size + 2  # CRLF after each chunk
+            if not size:
+                return status, body, keep_alive
+    if length is None:
+        return (status, buf[pos:], False) if eof else None
+    if len(buf) < pos + length:
+        return None
+    return status, buf[pos:pos + length], keep_alive
+
+
+class HttpClient:
+    """
+    Minimal non-blocking HTTP/1.1 client that keeps one connection to a
+    single server open across requests, reconnecting when the server closes
+    it or a request fails. A request is started with ``start()`` and
+    advanced by calling ``poll()`` (i.e. from a microdot idle handler) until
+    it returns the response, so connecting, sending and waiting for the
+    response never block the caller. The server's address is resolved once
+    and kept until a request fails, as ``getaddrinfo()`` is blocking. Only
+    plain ``http://`` URLs are supported.
+    """
+
+    def __init__(self, url: str, timeout: float = 2):
+        """
+        :param url: Base URL of the server, i.e. ``http://10.0.0.5:9091``;
+          any path is used as a prefix for request paths
+        :param timeout: Seconds after which a request that has not been
+          answered fails
+        """
+        if not url.startswith('http://'):
+            raise ValueError('Only http:// URLs are supported: ' + url)
+        hostport, _, prefix = url[7:].partition('/')
+        self.prefix: str = '/' + prefix.rstrip('/') if prefix else ''
+        host, _, port = hostport.partition(':')
+        self.host: str = host
+        self.port: int = int(port) if port else 80
+        self.timeout_ms: int = int(timeout * 1000)
+        self.addr = None
+        self.sock = None
+        self._poller = None
+        #: The request in flight, if any
+        self._request: Optional[bytes] = None
+        self._out: bytes = b''
+        self._in: bytes = b''
+        self._started: int = 0
+        self._retried: bool = False
+        #: Number of TCP connections opened
+        self.connects: int = 0
+
+    @property
+    def busy(self) -> bool:
+        """Whether a request is in flight."""
+        return self._request is not None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self._poller = None
+
+    def _connect(self):
+        if self.addr is None:
+            self.addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        sock = socket.socket()
+        sock.setblocking(False)
+        try:
+            sock.connect(self.addr)
+        except OSError as ex:
+            if ex.args[0] not in _WOULD_BLOCK:
+                sock.close()
+                raise
+        self.sock = sock
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLOUT | select.POLLIN)
+        self.connects += 1
+
+    def start(
+        self, method: str, path: str, body: bytes = b'',
+        headers: Optional[Dict[str, str]] = None
+    ):
+        """
+        Start a request; the response is returned by ``poll()``. Raises
+        ``OSError`` if the server's address can't be resolved or the
+        connection fails immediately.
+        """
+        # a URL without a path, requested with an empty path, targets '/'
+        target = self.prefix + path or '/'
+        head = '%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n' % (
+            method, target, self.host, len(body)
+        )
+        for k, v in (headers or {}).items():
+            head += '%s: %s\r\n' % (k, v)
+        self._request = head.encode() + b'\r\n' + body
+        self._retried = False
+        try:
+            self._begin()
+        except OSError:
+            self._fail()
+            raise
+
+    def _begin(self):
+        self._out = self._request
+        self._in = b''
+        self._started = ticks_ms()
+        if self.sock is None:
+            self._retried = True  # a new connection is not retried
+            self._connect()
+        else:
+            self._poller.modify(self.sock, select.POLLOUT | select.POLLIN)
+
+    def _fail(self):
+        self.close()
+        self._request = None
+        # resolve again next time, in case the server has moved
+        self.addr = None
+
+    def poll(self) -> Optional[Tuple[int, bytes]]:
+        """
+        Advance the request in flight without blocking.
+
+        :return: 2-tuple of the response status code and body once the
+          response has been received, otherwise None. Raises ``OSError`` if
+          the request fails or times out; a request that fails on a reused
+          connection is retried once on a new connection.
+        """
+        if self._request is None:
+            return None
+        try:
+            return self._step()
+        except OSError as ex:
+            if self._retried:
+                self._fail()
+                raise
+            logger.debug('Reused connection failed (%s); reconnecting', ex)
+            self.close()
+            self._retried = True
+            try:
+                self._begin()
+            except OSError:
+                self._fail()
+                raise
+            return None
+
+    def _step(self) -> Optional[Tuple[int, bytes]]:
+        if ticks_diff(ticks_ms(), self._started) > self.timeout_ms:
+            raise OSError(errno.ETIMEDOUT, 'request timed out')
+        events = self._poller.poll(0)
+        if not events:
+            return None
+        ev = events[0][1]
+        if ev & select.POLLOUT and self._out:
+            try:
+                n = self.sock.send(self._out)
+            except OSError as ex:
+                if ex.args[0] not in _WOULD_BLOCK:
+                    raise
+                n = 0
+            self._out = self._out[n:]
+            if not self._out:
+                self._poller.modify(self.sock, select.POLLIN)
+        if ev & select.POLLIN:
+            try:
+                data = self.sock.recv(1024)
+            except OSError as ex:
+                if ex.args[0] not in _WOULD_BLOCK:
+                    raise
+                return None
+            self._in += data
+            resp = parse_response(self._in, eof=not data)
+            if resp is None and not data:
+                raise OSError('connection closed by server')
+            if resp is not None:
+                self._request = None
+                status, body, keep_alive = resp
+                if not keep_alive:
+                    self.close()
+                return status, body
+        elif ev & (select.POLLERR | select.POLLHUP):
+            raise OSError('connection failed')
+        return None
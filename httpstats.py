@@ -0,0 +1,143 @@
+from array import array
+from time import ticks_diff
+from typing import Dict, List, Tuple
+
+from utils import floatToGoString
+
+
+class Histogram:
+    """
+    A Prometheus histogram of durations measured in milliseconds, kept as one
+    count per bucket so that an observation is a short scan and an
+    increment, with no allocation.
+    """
+
+    def __init__(self, bounds_ms: Tuple[int, ...]):
+        """
+        :param bounds_ms: Upper bounds of the buckets, in milliseconds, in
+          increasing order; a ``+Inf`` bucket is added
+        """
+        self.bounds_ms: Tuple[int, ...] = bounds_ms
+        self.counts: array = array('L', (0 for _ in range(len(bounds_ms) + 1)))
+        self.sum_ms: int = 0
+
+    def observe(self, ms: int):
+        i = 0
+        for bound in self.bounds_ms:
+            if ms <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum_ms += ms
+
+    def values(self, name: str) -> List[Tuple[Dict, float]]:
+        """
+        Return the ``_bucket``, ``_sum`` and ``_count`` samples of the
+        histogram, in seconds, with each sample's name in its ``__name__``
+        label.
+        """
+        values = []
+        total = 0
+        for i, bound in enumerate(self.bounds_ms):
+            total += self.counts[i]
+            values.append((
+                {'__name__': name + '_bucket',
+                 'le': floatToGoString(bound / 1000)}, total
+            ))
+        total += self.counts[-1]
+        values.append(({'__name__': name + '_bucket', 'le': '+Inf'}, total))
+        values.append(({'__name__': name + '_sum'}, self.sum_ms / 1000))
+        values.append(({'__name__': name + '_count'}, total))
+        return values
+
+
+class ServerStats:
+    """
+    Instrumentation of the microdot server, set as the app's ``stats`` so
+    that ``request_done()`` is called after each response is written. Keeps
+    request counts by route and status, request and response byte counts,
+    and histograms of the time to the first byte of the response (from
+    accepting the connection, or from the start of the request on a
+    persistent connection), of rendering the response and of writing it, so
+    a slow scrape can be attributed to the network, the handler or the
+    socket writes.
+    """
+
+    #: Histogram bucket upper bounds, in milliseconds
+    BUCKETS_MS: Tuple[int, ...] = (
+        5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000
+    )
+
+    def __init__(self):
+        #: Request counts, by (route, status code)
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.request_bytes: int = 0
+        self.response_bytes: int = 0
+        self.first_byte: Histogram = Histogram(self.BUCKETS_MS)
+        self.render: Histogram = Histogram(self.BUCKETS_MS)
+        self.write: Histogram = Histogram(self.BUCKETS_MS)
+
+    def request_done(
+        self, req, res, written: int, started: int, dispatched: int,
+        rendered: int, finished: int
+    ):
+        """
+        Record a request whose response has been written.
+
+        :param req: The request, or None if it could not be parsed
+        :param res: The response
+        :param written: Number of bytes of the response written
+        :param started: ``ticks_ms()`` when the connection was accepted, or
+          when the request started to arrive on a persistent connection
+        :param dispatched: ``ticks_ms()`` when the request was dispatched
+        :param rendered: ``ticks_ms()`` when the response started to be
+          written
+        :param finished: ``ticks_ms()`` when the response was written
+        """
+        key = ((req and req.route) or '', res.status_code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        if req:
+            self.request_bytes += req.head_length + req.content_length
+        self.response_bytes += written
+        self.first_byte.observe(ticks_diff(rendered, started))
+        self.render.observe(ticks_diff(rendered, dispatched))
+        self.write.observe(ticks_diff(finished, rendered))
+
+    def metric_families(self) -> List[Tuple]:
+        return [
+            (
+                'esp_http_requests_total',
+                'Number of HTTP requests served, by route and status code.',
+                [
+                    ({'route': route, 'status': str(status)}, count)
+                    for (route, status), count in self.requests.items()
+                ], 'counter'
+            ),
+            (
+                'esp_http_request_bytes_total',
+                'Bytes received in HTTP request heads and bodies.',
+                [({}, self.request_bytes)], 'counter'
+            ),
+            (
+                'esp_http_response_bytes_total',
+                'Bytes of HTTP responses written.',
+                [({}, self.response_bytes)], 'counter'
+            ),
+            (
+                'esp_http_first_byte_seconds',
+                'Time from accepting a connection (or the start of a request '
+                'on a persistent one) to starting to write the response.',
+                self.first_byte.values('esp_http_first_byte_seconds'),
+                'histogram'
+            ),
+            (
+                'esp_http_render_seconds',
+                'Time spent dispatching requests and rendering responses.',
+                self.render.values('esp_http_render_seconds'), 'histogram'
+            ),
+            (
+                'esp_http_write_seconds',
+                'Time spent writing responses to the socket.',
+                self.write.values('esp_http_write_seconds'), 'histogram'
+            ),
+        ]
@@ -2,105 +2,189 @@
 Base class for connecting to WiFi and exposing GPIO to Prometheus
 """
 
+from time import time, ticks_ms, ticks_diff
+
+#: ticks_ms() as early as possible during boot, to measure boot duration
+BOOT_TICKS: int = ticks_ms()
+
 import os
 import sys
 import network
 import machine
-from time import sleep, time
 from binascii import hexlify
 import ntptime
 import gc
-from typing import List
+from typing import List, Dict, Tuple
 
 from config import SSID, WPA_KEY
 from device_config import DEVICE_CONFIG
 from utils import (
-    wlan_status_code, logger, time_to_unix_time, prom_metric_str
+    logger, time_to_unix_time, prom_metric_str, server_tls_context,
+    unix_time_ms
 )
-from promdevice import PrometheusDevice, GpioSensor
-from microdot import Microdot, URLPattern
-
-try:
-    import ujson
-except ImportError:
-    import json as ujson
+from promdevice import PrometheusDevice, Sensor, create_sensor
+from microdot import URLPattern, concurrency_mode
+from eventstream import EventStreamHub
+from wlanconnect import WlanConnector
 
 gc.collect()  # enable garbage collection
 
-app = Microdot()
+#: Startup stages, in the order they normally complete: sensors initialized,
+#: WLAN associated with an IP address, HTTP server started, clock set from
+#: NTP, and persisted sensor state restored
+STARTUP_STAGES: Tuple[str, ...] = ('sensors', 'wlan', 'http', 'ntp', 'state')
+
+#: Milliseconds between attempts to set the clock from NTP; doubled after
+#: each failure, up to ``NTP_MAX_RETRY_MS``
+NTP_RETRY_MS: int = 5000
+NTP_MAX_RETRY_MS: int = 300000
+
+#: Seconds to wait for an NTP reply; the query blocks the idle loop
+NTP_TIMEOUT: float = 0.5
+
+#: Failed NTP attempts after which persisted state is restored anyway
+NTP_TRIES_BEFORE_RESTORE: int = 5
 
 
 class PromGpio:
 
     def __init__(self):
         logger.debug("Init")
+        self.pusher = None
+        self.mqtt = None
+        self.webhooks = None
+        self.statsd = None
+        self.httpstats = None
+        self.app = None
+        #: Milliseconds from BOOT_TICKS until each completed startup stage
+        self.stages: Dict[str, int] = {}
+        self.time_synced: bool = False
+        self.ntp_failures: int = 0
+        self._ntp_last_try: int = 0
+        # ntptime's default of 1s would block requests for that long on
+        # every failed attempt
+        ntptime.timeout = NTP_TIMEOUT
+        self.boot_duration: float = 0
         self.unique_id: str = hexlify(machine.unique_id()).decode()
         devconf = DEVICE_CONFIG[self.unique_id]
-        pins = [GpioSensor(**x) for x in devconf.get('pins', [])]
-        del devconf['pins']
+        pins = [create_sensor(x) for x in devconf.get('pins', [])]
+        devconf.pop('pins', None)
         self.device: PrometheusDevice = PrometheusDevice(
             **devconf, pins=pins
         )
         del devconf
         del pins
+        # sensors are live (and recording transitions) from here on
+        self._stage_done('sensors')
         logger.debug('Set hostname to: %s' % self.device.hostname)
         network.hostname(self.device.hostname)
         logger.debug('Instantiate WLAN')
         self.wlan = network.WLAN(network.STA_IF)
-        logger.debug('connect_wlan()')
-        self.connect_wlan()
+        self.wlan_connector: WlanConnector = WlanConnector(
+            self.wlan, SSID, WPA_KEY, reuse_ip=self.device.wlan_reuse_ip
+        )
+        logger.debug('start WLAN connection')
+        self.wlan_connector.start()
         logger.debug('hexlify mac')
         self.mac = hexlify(self.wlan.config('mac')).decode()
         logger.debug('MAC: %s' % self.mac)
         self.mac_colons = ':'.join(
             [self.mac[i:i + 2] for i in range(0, len(self.mac), 2)]
         )
-        self._set_time_from_ntp()
         self.boot_time = time()
+        gc.collect()
 
-    def _set_time_from_ntp(self):
-        logger.debug('Setting time from NTP...')
-        logger.debug('Current time: %s' % time())
-        for _ in range(0, 5):
-            try:
-                ntptime.settime()
-                logger.debug('Time set via NTP; new time: %s' % time())
-                return
-            except Exception as ex:
-                logger.debug(
-                    'Failed setting time via NTP: %s; try again in 5s' % ex
-                )
-                sleep(5)
-        logger.debug('ERROR: Could not set time via NTP')
-
-    def connect_wlan(self):
-        logger.debug('set wlan to active')
-        self.wlan.active(True)
-        logger.debug('test if wlan is connected')
-        if not self.wlan.isconnected():
-            logger.debug('connecting to network...')
-            self.wlan.connect(SSID, WPA_KEY)
-            logger.debug('MAC: %s' % hexlify(self.wlan.config('mac')).decode())
-            for _ in range(0, 60):
-                if self.wlan.isconnected():
-                    logger.debug('WLAN is connected')
-                    break
-                stat = self.wlan.status()
-                logger.debug(
-                    'WLAN is not connected; sleep 1s; status=%s' %
-                    wlan_status_code.get(stat, stat)
-                )
-                sleep(1)
-            else:
-                logger.debug('Could not connect to WLAN after 15s; reset')
-                machine.reset()
+    def _stage_done(self, stage: str):
+        self.stages[stage] = ticks_diff(ticks_ms(), BOOT_TICKS)
+        logger.debug('Startup stage %s done after %dms', stage,
+                     self.stages[stage])
+
+    def _poll_ntp(self):
+        """
+        Try to set the clock from NTP, unless it has been set or the retry
+        interval since the last failed try has not passed yet. Registered as
+        a microdot idle handler, so the HTTP server is already serving
+        meanwhile. Timestamps recorded before the clock was set are shifted
+        by the step, and persisted timestamps (which are only comparable
+        with a set clock) are restored afterwards.
+        """
+        if self.time_synced or (
+            self.ntp_failures and
+            ticks_diff(ticks_ms(), self._ntp_last_try) < self._ntp_retry_ms()
+        ):
+            return
+        self._ntp_last_try = ticks_ms()
+        before = unix_time_ms()
+        try:
+            ntptime.settime()
+        except Exception as ex:
+            self.ntp_failures += 1
+            logger.debug(
+                'Failed setting time via NTP: %s; try again in %dms',
+                ex, self._ntp_retry_ms()
+            )
+            if self.ntp_failures == NTP_TRIES_BEFORE_RESTORE:
+                logger.debug('ERROR: Could not set time via NTP')
+                self._restore_state()
+            return
+        # the clock step, excluding the time the NTP query itself took
+        step_ms = unix_time_ms() - before - ticks_diff(
+            ticks_ms(), self._ntp_last_try
+        )
+        self._adjust_time(step_ms)
+        self.time_synced = True
+        self._stage_done('ntp')
+        logger.debug(
+            'Time set via NTP; new time: %s; clock stepped by %dms',
+            time(), step_ms
+        )
+        if 'state' not in self.stages:
+            self._restore_state()
+        if self.device.persister is not None:
+            # whatever was saved before the step holds unset-clock
+            # timestamps, which a restore would take for real ones
+            self.device.persister.save()
+
+    def _ntp_retry_ms(self) -> int:
+        return min(
+            NTP_MAX_RETRY_MS,
+            NTP_RETRY_MS * 2 ** min(max(self.ntp_failures - 1, 0), 6)
+        )
+
+    def _adjust_time(self, step_ms: int):
+        step = (step_ms + 500) // 1000
+        self.boot_time += step
+        for sensor in self.device.sensors:
+            sensor.adjust_time(step)
+        self.device.events.adjust_time(step_ms)
+        if self.device.history is not None:
+            self.device.history.adjust_time(step_ms)
+        if self.pusher is not None:
+            self.pusher.adjust_time(step_ms)
+        if self.webhooks is not None:
+            self.webhooks.adjust_time(step)
+
+    def _restore_state(self):
+        if self.device.persister is not None:
+            self.device.persister.restore()
+        self._stage_done('state')
+
+    def wait_for_wlan(self):
+        """
+        Wait until the WLAN is associated and has an IP address, resetting
+        the board if that takes more than 60 seconds.
+        """
+        if not self.wlan_connector.wait(60000):
+            logger.debug('Could not connect to WLAN after 60s; reset')
+            machine.reset()
+        self._stage_done('wlan')
         print('network config:', self.wlan.ifconfig())
 
-    def _internal_metrics(self) -> str:
+    def _internal_metric_families(self) -> List[Tuple]:
         rel: str = os.uname().release
         r: List[str] = rel.split('.')
-        return \
-            prom_metric_str(
+        return [
+            (
                 'python_info', 'Python platform information.',
                 [(
                     {
@@ -111,9 +195,9 @@ class PromGpio:
                         'version': rel
                     },
                     1.0
-                )]
-            ) + \
-            prom_metric_str(
+                )], 'gauge'
+            ),
+            (
                 'esp_info', 'Information about the underlying platform.',
                 [(
                     {
@@ -123,66 +207,380 @@ class PromGpio:
                         'hostname': self.device.hostname
                     },
                     1.0
-                )]
-            ) + \
-            prom_metric_str(
+                )], 'gauge'
+            ),
+            (
                 'process_start_time_seconds',
                 'Start time of the process since unix epoch in seconds.',
-                [({}, time_to_unix_time(self.boot_time))]
-            ) + \
-            prom_metric_str(
+                [({}, time_to_unix_time(self.boot_time))], 'gauge'
+            ),
+            (
                 'process_uptime_seconds',
                 'Number of seconds since the process started.',
-                [({}, time() - self.boot_time)]
-            )
+                [({}, time() - self.boot_time)], 'gauge'
+            ),
+            (
+                'esp_boot_duration_seconds',
+                'Seconds from the start of main.py until the HTTP server '
+                'started.',
+                [({}, self.boot_duration)], 'gauge'
+            ),
+            (
+                'esp_startup_stage_ready',
+                'Whether each startup stage has completed.',
+                [
+                    ({'stage': stage}, 1 if stage in self.stages else 0)
+                    for stage in STARTUP_STAGES
+                ], 'gauge'
+            ),
+            (
+                'esp_startup_stage_seconds',
+                'Seconds from the start of main.py until each completed '
+                'startup stage.',
+                [
+                    ({'stage': stage}, self.stages[stage] / 1000)
+                    for stage in STARTUP_STAGES if stage in self.stages
+                ], 'gauge'
+            ),
+            (
+                'esp_ntp_failures_total',
+                'Number of failed attempts to set the clock from NTP.',
+                [({}, self.ntp_failures)], 'counter'
+            ),
+            (
+                'esp_heap_free_bytes',
+                'Free bytes on the MicroPython heap.',
+                [({}, gc.mem_free())], 'gauge'
+            ),
+            (
+                'esp_heap_allocated_bytes',
+                'Allocated bytes on the MicroPython heap.',
+                [({}, gc.mem_alloc())], 'gauge'
+            ),
+        ]
 
-    def prom_gpio_metric_str(self, name: str, help: str, attr_name: str) -> str:
-        values = []
-        pin: GpioSensor
-        for pin in self.device.pins:
-            values.append((
-                {
-                    'hostname': self.device.hostname,
-                    'pin_name': pin.name,
-                    'pin_number': pin.pin_num
-                },
-                getattr(pin, attr_name)
+    def sensor_metric_families(self) -> List[Tuple]:
+        """
+        Collect the metrics of every sensor on the device, grouped into one
+        family per metric name, as 4-tuples of the positional arguments to
+        ``prom_metric_str``.
+        """
+        families: Dict[str, Tuple] = {}
+        order: List[str] = []
+        sensor: Sensor
+        for sensor in self.device.sensors:
+            labels = sensor.labels()
+            labels['hostname'] = self.device.hostname
+            for name, help, attr_name, metric_type in sensor.metrics:
+                if name not in families:
+                    families[name] = (name, help, [], metric_type)
+                    order.append(name)
+                families[name][2].append((labels, getattr(sensor, attr_name)))
+        return [families[name] for name in order]
+
+    def _feature_metric_families(self) -> List[Tuple]:
+        families: List[Tuple] = [
+            (
+                'gpio_events_total',
+                'Number of transitions recorded in the event buffer.',
+                [({}, self.device.events.next_seq)], 'counter'
+            ),
+            (
+                'gpio_events_overwritten_total',
+                'Number of transitions overwritten in the event buffer.',
+                [({}, self.device.events.overwritten)], 'counter'
+            ),
+        ]
+        if self.device.persister is not None:
+            families.append((
+                'esp_state_restored',
+                'Whether sensor state was restored after boot (1) or not (0), '
+                'and from where.',
+                [(
+                    {'source': self.device.persister.source},
+                    1 if self.device.persister.restored else 0
+                )], 'gauge'
+            ))
+            families.append((
+                'esp_state_flash_writes_total',
+                'Number of times persisted state was written to flash.',
+                [({}, self.device.persister.flash_writes)], 'counter'
+            ))
+        if self.device.history is not None:
+            families.append((
+                'gpio_history_bytes_used',
+                'Bytes in use in the history buffer.',
+                [({}, self.device.history.used)], 'gauge'
+            ))
+            families.append((
+                'gpio_history_dropped_total',
+                'Number of history records dropped to stay within the '
+                'memory budget or retention period.',
+                [({}, self.device.history.dropped)], 'counter'
+            ))
+        if self.pusher is not None:
+            families.append((
+                'esp_push_total', 'Number of successful metric pushes.',
+                [({}, self.pusher.pushes)], 'counter'
+            ))
+            families.append((
+                'esp_push_failures_total', 'Number of failed metric pushes.',
+                [({}, self.pusher.failures)], 'counter'
+            ))
+            families.append((
+                'esp_push_dropped_total',
+                'Number of unsent metric snapshots dropped from the backlog.',
+                [({}, self.pusher.dropped)], 'counter'
+            ))
+            families.append((
+                'esp_push_backlog', 'Number of unsent metric snapshots.',
+                [({}, len(self.pusher.backlog))], 'gauge'
+            ))
+        if self.mqtt is not None:
+            families.append((
+                'esp_mqtt_connected',
+                'Whether the MQTT connection is up (1) or not (0).',
+                [({}, 1 if self.mqtt.connected else 0)], 'gauge'
+            ))
+            families.append((
+                'esp_mqtt_published_total',
+                'Number of MQTT state messages published.',
+                [({}, self.mqtt.published)], 'counter'
+            ))
+            families.append((
+                'esp_mqtt_connection_failures_total',
+                'Number of failed or lost MQTT connections.',
+                [({}, self.mqtt.reconnects)], 'counter'
+            ))
+            families.append((
+                'esp_mqtt_inflight',
+                'Number of unacknowledged MQTT messages.',
+                [({}, len(self.mqtt.inflight))], 'gauge'
+            ))
+        if self.webhooks is not None:
+            families.append((
+                'esp_webhook_queue_depth',
+                'Number of webhook notifications waiting to be sent.',
+                [({}, self.webhooks.queue_depth)], 'gauge'
             ))
-        return prom_metric_str(name, help, values)
+            families.append((
+                'esp_webhook_sent_total',
+                'Number of webhook notifications sent.',
+                [({}, self.webhooks.sent)], 'counter'
+            ))
+            families.append((
+                'esp_webhook_failures_total',
+                'Number of failed webhook requests.',
+                [({}, self.webhooks.failures)], 'counter'
+            ))
+            families.append((
+                'esp_webhook_dropped_total',
+                'Number of webhook notifications dropped unsent.',
+                [({}, self.webhooks.dropped)], 'counter'
+            ))
+        if self.statsd is not None:
+            families.append((
+                'esp_statsd_packets_total',
+                'Number of StatsD datagrams sent.',
+                [({}, self.statsd.packets)], 'counter'
+            ))
+            families.append((
+                'esp_statsd_errors_total',
+                'Number of StatsD datagrams that could not be sent.',
+                [({}, self.statsd.errors)], 'counter'
+            ))
+        if self.app is not None:
+            families.append((
+                'esp_http_connections_active',
+                'Number of HTTP connections currently admitted.',
+                [({}, self.app.connections_active)], 'gauge'
+            ))
+            families.append((
+                'esp_http_connections_shed_total',
+                'Number of HTTP connections rejected with a 503 because the '
+                'server was saturated.',
+                [({}, self.app.connections_shed_total)], 'counter'
+            ))
+        if self.httpstats is not None:
+            families.extend(self.httpstats.metric_families())
+        families.extend(self.wlan_connector.metric_families())
+        if self.app is not None and self.app.ssl:
+            families.append((
+                'esp_http_tls_handshakes_total',
+                'Number of completed TLS handshakes.',
+                [({}, self.app.tls_handshakes_total)], 'counter'
+            ))
+            families.append((
+                'esp_http_tls_sessions_resumed_total',
+                'Number of TLS handshakes that resumed an earlier session.',
+                [({}, self.app.tls_sessions_resumed_total)], 'counter'
+            ))
+            if self.device.server_mode == 'sync':
+                # handshakes are performed by the event loop in async mode,
+                # so failed ones never reach the app and none are timed
+                families.append((
+                    'esp_http_tls_handshake_failures_total',
+                    'Number of failed TLS handshakes.',
+                    [({}, self.app.tls_handshake_failures_total)], 'counter'
+                ))
+                families.append((
+                    'esp_http_tls_handshake_seconds_total',
+                    'Total duration of completed TLS handshakes.',
+                    [({}, self.app.tls_handshake_ms_total / 1000)],
+                    'counter'
+                ))
+                families.append((
+                    'esp_http_tls_handshake_seconds_max',
+                    'Duration of the slowest TLS handshake.',
+                    [({}, self.app.tls_handshake_ms_max / 1000)], 'gauge'
+                ))
+        if self.app is not None and self.app.worker_threads and \
+                concurrency_mode == 'threaded':
+            families.append((
+                'esp_http_workers', 'Number of HTTP worker threads.',
+                [({}, self.app.worker_threads)], 'gauge'
+            ))
+            families.append((
+                'esp_http_workers_busy',
+                'Number of HTTP worker threads handling a connection.',
+                [({}, self.app.workers_busy)], 'gauge'
+            ))
+            families.append((
+                'esp_http_worker_queue_depth',
+                'Number of connections waiting for an HTTP worker.',
+                [({}, len(self.app.work_queue))], 'gauge'
+            ))
+            families.append((
+                'esp_http_worker_queued_total',
+                'Number of connections handed to the HTTP worker pool.',
+                [({}, self.app.worker_queued_total)], 'counter'
+            ))
+            families.append((
+                'esp_http_worker_wait_seconds_total',
+                'Total seconds connections waited for an HTTP worker.',
+                [({}, self.app.worker_wait_ms_total / 1000)], 'counter'
+            ))
+            families.append((
+                'esp_http_worker_rejected_total',
+                'Number of connections closed because the HTTP worker '
+                'queue was full.',
+                [({}, self.app.worker_rejected_total)], 'counter'
+            ))
+        return families
+
+    def metric_families(self) -> List[Tuple]:
+        """
+        Collect every metric we expose, as 4-tuples of the positional
+        arguments to ``prom_metric_str``.
+        """
+        return self._internal_metric_families() + \
+            self.sensor_metric_families() + \
+            self._feature_metric_families()
 
     def handle_request(self, _) -> str:
-        s: str = self._internal_metrics()
-        s += self.prom_gpio_metric_str(
-            'gpio_pin_is_on',
-            'Whether the GPIO pin is on (1) or off (2)',
-            'input_state'
-        )
-        s += self.prom_gpio_metric_str(
-            'gpio_pin_on_seconds',
-            'How many seconds the pin has been on; -1 if it is off.',
-            'input_on_seconds'
-        )
-        s += self.prom_gpio_metric_str(
-            'gpio_pin_off_seconds',
-            'How many seconds the pin has been off; -1 if it is on.',
-            'input_off_seconds'
-        )
-        s += self.prom_gpio_metric_str(
-            'gpio_pin_seconds_since_on',
-            'How many seconds since the pin last turned on.',
-            'seconds_since_on'
-        )
-        s += self.prom_gpio_metric_str(
-            'gpio_pin_seconds_since_off',
-            'How many seconds since the pin last turned off.',
-            'seconds_since_off'
-        )
-        return s + '\n'
+        return ''.join(
+            [prom_metric_str(*family) for family in self.metric_families()]
+        ) + '\n'
+
+    def handle_events(self, req):
+        try:
+            since = req.args.get('since', 0, type=int)
+        except ValueError:
+            return 'since must be an integer', 400
+        return self.device.events.render_since(max(0, since))
+
+    def handle_history(self, _):
+        if self.device.history is None:
+            return 'History buffer is disabled', 404
+        return self.device.history.render(
+            {'hostname': self.device.hostname}
+        ), {'Content-Type': self.device.history.CONTENT_TYPE}
 
     def run(self):
         logger.debug('Run method; call app.run()')
+        if self.device.server_mode == 'async':
+            from microdot_asyncio import Microdot, Request, Response
+        else:
+            from microdot import Microdot, Request, Response
+        # our handlers don't keep requests once they return (the event stream
+        # detaches its connection), so request objects can be reused
+        Request.pool_size = Response.pool_size = 2
+        app = Microdot()
+        app.priority_addresses = self.device.priority_addresses
+        self.app = app
+        if self.device.http_stats:
+            from httpstats import ServerStats
+            self.httpstats = ServerStats()
+            app.stats = self.httpstats
         app.url_map.append((['GET'], URLPattern('/'), self.handle_request))
-        app.run(port=80)
+        app.url_map.append(
+            (['GET'], URLPattern('/events'), self.handle_events)
+        )
+        hub = EventStreamHub(self.device.events)
+        app.url_map.append(
+            (['GET'], URLPattern('/events/stream'), hub.handle_request)
+        )
+        app.idle(hub.poll)
+        app.url_map.append(
+            (['GET'], URLPattern('/history'), self.handle_history)
+        )
+        if self.device.history is not None:
+            app.idle(self.device.history.poll)
+        if self.device.persister is not None:
+            app.idle(self.device.persister.poll)
+        if self.device.push:
+            from push import Pusher
+            self.pusher = Pusher(
+                self.metric_families, self.device.sensors, **self.device.push
+            )
+            app.idle(self.pusher.poll)
+        if self.device.mqtt:
+            from mqtt import MqttPublisher
+            self.mqtt = MqttPublisher(self.device.sensors, **self.device.mqtt)
+            app.idle(self.mqtt.poll)
+        if any([s.webhook for s in self.device.sensors]):
+            from webhook import WebhookNotifier
+            self.webhooks = WebhookNotifier(
+                self.device.name, self.device.sensors,
+                max_queue=self.device.webhook_queue
+            )
+            app.idle(self.webhooks.poll)
+        if self.device.statsd:
+            from statsd import StatsdEmitter
+            self.statsd = StatsdEmitter(
+                self.metric_families, self.device.sensors,
+                **self.device.statsd
+            )
+            app.idle(self.statsd.poll)
+        if self.device.server_mode == 'async':
+            # transitions are handled right away instead of at the next
+            # idle_interval; ThreadSafeFlag is safe to set from an IRQ
+            for sensor in self.device.sensors:
+                sensor.listeners.append(lambda _: app.wake())
+            if 'touchsensor' in sys.modules:
+                app.background(sys.modules['touchsensor'].sampler.run)
+        app.idle(self._poll_ntp)
+        # everything above only needs the sensors; serve as soon as we have
+        # an IP address, and set the clock in the background
+        self.wait_for_wlan()
+        self._stage_done('http')
+        self.boot_duration = self.stages['http'] / 1000
+        gc.collect()
+        logger.info(
+            'Boot took %ss; %d bytes heap free', self.boot_duration,
+            gc.mem_free()
+        )
+        if self.device.tls:
+            # one context for all connections, so that clients can resume
+            # their sessions instead of paying for a full handshake
+            app.run(
+                port=self.device.tls.get('port', 443),
+                ssl=server_tls_context(
+                    self.device.tls['cert'], self.device.tls['key']
+                )
+            )
+        else:
+            app.run(port=80)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,10 @@
 TYPE_CHECKING = False
 
 
+class Callable:
+    pass
+
+
 class Dict:
     pass
 
@@ -20,18 +20,33 @@ except ImportError:
 
 concurrency_mode = 'threaded'
 
+
+class _NoLock:
+    # stands in for a lock where there are no threads
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
 try:  # pragma: no cover
     import threading
 
     def create_thread(f, *args, **kwargs):
         # use the threading module
         threading.Thread(target=f, args=args, kwargs=kwargs).start()
+
+    # guards state shared by all connections' request and response objects,
+    # which worker threads use concurrently in the threaded concurrency mode
+    _shared_lock = threading.Lock()
 except ImportError:  # pragma: no cover
     def create_thread(f, *args, **kwargs):
         # no threads available, call function synchronously
         f(*args, **kwargs)
 
     concurrency_mode = 'sync'
+    _shared_lock = _NoLock()
 
 try:
     import ujson as json
@@ -43,6 +58,22 @@ try:
 except ImportError:
     import re
 
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
 socket_timeout_error = OSError
 try:
     import usocket as socket
@@ -146,6 +177,10 @@ class NoCaseDict(dict):
         kl = key.lower()
         return super().get(self.keymap.get(kl, kl), default)
 
+    def clear(self):
+        super().clear()
+        self.keymap.clear()
+
     def update(self, other_dict):
         for key, value in other_dict.items():
             self[key] = value
@@ -275,8 +310,95 @@ class MultiDict(dict):
         return values
 
 
+def _find_head_end(data):
+    # return the offsets of the end of the request head and of the start of
+    # the body, or (-1, -1) if the head is incomplete; heads ending in a bare
+    # LF line are accepted, as by the line-by-line parser
+    end = data.find(b'\r\n\r\n')
+    lf_end = data.find(b'\n\n')
+    if lf_end >= 0 and (end < 0 or lf_end < end):
+        return lf_end, lf_end + 2
+    if end >= 0:
+        return end, end + 4
+    return -1, -1
+
+
+class _PrefixedStream():
+    # a stream that returns bytes that were already received from the client
+    # before reading from the underlying stream; wraps a connection for its
+    # lifetime, so that bytes received past the end of one request (i.e. a
+    # pipelined request) are kept for the next. Given the socket, it reads
+    # from it directly, as request heads are received with recv(): bytes
+    # taken in by a buffered reader (i.e. CPython's makefile()) while reading
+    # a body would be invisible to the next head, and to the poller
+    def __init__(self, prefix, stream, sock=None):
+        self.prefix = prefix
+        self.stream = stream
+        self.sock = sock
+
+    def _recv(self, size):
+        if self.sock is not None:
+            return self.sock.recv(size)
+        return self.stream.read(size)
+
+    def read(self, size=-1):
+        if not self.prefix:
+            if size >= 0:
+                return self._recv(size)
+            if self.sock is None:
+                return self.stream.read()
+            data = b''
+            while True:
+                chunk = self.sock.recv(1024)
+                if not chunk:
+                    return data
+                data += chunk
+        if 0 <= size < len(self.prefix):
+            data = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+        else:
+            data = self.prefix
+            self.prefix = b''
+        return data
+
+    def readline(self, size=-1):
+        i = self.prefix.find(b'\n')
+        if self.sock is not None:
+            # receive into the prefix until it holds a whole line
+            while i < 0 and (size < 0 or len(self.prefix) < size):
+                chunk = self.sock.recv(256)
+                if not chunk:
+                    break
+                self.prefix += chunk
+                i = self.prefix.find(b'\n')
+        if i < 0:
+            if not self.prefix:
+                return self.stream.readline(size) if self.sock is None \
+                    else b''
+            i = len(self.prefix) - 1
+        return self.read(i + 1 if size < 0 else min(i + 1, size))
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def flush(self):
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
 class Request():
     """An HTTP request."""
+    __slots__ = ('app', 'client_addr', 'method', 'url', 'path',
+                 'query_string', 'args', '_headers', '_raw_headers',
+                 '_raw_headers_lower', '_cookies', 'content_length', '_g',
+                 'http_version', '_body', 'body_used', '_stream',
+                 'stream_used', 'sock', '_json', '_form',
+                 'after_request_handlers', 'detached', 'url_args', 'route',
+                 'started', 'head_length')
+
     #: Specify the maximum payload size that is accepted. Requests with larger
     #: payloads will be rejected with a 413 status code. Applications can
     #: change this maximum as necessary.
@@ -306,17 +428,51 @@ class Request():
     #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
     max_readline = 2 * 1024
 
+    #: Specify the maximum length allowed for the request line and headers
+    #: together, when they are read from a socket in one piece. Requests with
+    #: a longer head are rejected.
+    #:
+    #: Example::
+    #:
+    #:    Request.max_head_length = 8 * 1024  # 8KB request heads allowed
+    max_head_length = 4 * 1024
+
     #: Specify a suggested read timeout to use when reading the request. Set to
     #: 0 to disable the use of a timeout. This timeout should be considered a
     #: suggestion only, as some platforms may not support it. The default is
     #: 1 second.
     socket_read_timeout = 1
 
+    #: Specify the maximum total time, in seconds, allowed for receiving the
+    #: request line and headers (and, in the ``microdot_asyncio`` module, a
+    #: body that is read before the request is dispatched), so that a client
+    #: sending them very slowly cannot hold up the server indefinitely. On a
+    #: persistent connection the time starts when the next request begins to
+    #: arrive. Set to 0 to disable. The default is 5 seconds.
+    #:
+    #: Example::
+    #:
+    #:    Request.request_deadline = 10  # allow slow clients 10 seconds
+    request_deadline = 5
+
+    #: Specify how many request objects are kept after their requests are
+    #: handled, to be reused for later requests instead of allocating new
+    #: ones. Only enable this if the application does not keep references
+    #: to request objects after returning a response, other than for
+    #: detached connections. The default is 0, which disables the pool.
+    #:
+    #: Example::
+    #:
+    #:    Request.pool_size = 2
+    pool_size = 0
+
+    _pool = []
+
     class G:
         pass
 
     def __init__(self, app, client_addr, method, url, http_version, headers,
-                 body=None, stream=None, sock=None):
+                 body=None, stream=None, sock=None, raw_headers=b''):
         #: The application instance to which this request belongs.
         self.app = app
         #: The address of the client, as a tuple (host, port).
@@ -332,31 +488,23 @@ class Request():
         #: The parsed query string, as a
         #: :class:`MultiDict <microdot.MultiDict>` object.
         self.args = {}
-        #: A dictionary with the headers included in the request.
-        self.headers = headers
-        #: A dictionary with the cookies included in the request.
-        self.cookies = {}
+        # the headers are parsed from raw_headers on first access
+        self._headers = headers
+        self._raw_headers = raw_headers
+        self._raw_headers_lower = None
+        self._cookies = None
         #: The parsed ``Content-Length`` header.
         self.content_length = 0
-        #: The parsed ``Content-Type`` header.
-        self.content_type = None
-        #: A general purpose container for applications to store data during
-        #: the life of the request.
-        self.g = Request.G()
+        self._g = None
 
         self.http_version = http_version
         if '?' in self.path:
             self.path, self.query_string = self.path.split('?', 1)
             self.args = self._parse_urlencoded(self.query_string)
 
-        if 'Content-Length' in self.headers:
-            self.content_length = int(self.headers['Content-Length'])
-        if 'Content-Type' in self.headers:
-            self.content_type = self.headers['Content-Type']
-        if 'Cookie' in self.headers:
-            for cookie in self.headers['Cookie'].split(';'):
-                name, value = cookie.strip().split('=', 1)
-                self.cookies[name] = value
+        content_length = self._header('content-length')
+        if content_length:
+            self.content_length = int(content_length)
 
         self._body = body
         self.body_used = False
@@ -365,10 +513,45 @@ class Request():
         self.sock = sock
         self._json = None
         self._form = None
-        self.after_request_handlers = []
+        # replaced with a list when a handler is registered
+        self.after_request_handlers = ()
+        self.detached = False
+        self.url_args = None
+        #: The URL pattern of the route that handles the request, once it has
+        #: been dispatched.
+        self.route = None
+        #: The ``ticks_ms()`` value when the request started to arrive.
+        self.started = None
+        #: The length in bytes of the request line and headers.
+        self.head_length = 0
+
+    @classmethod
+    def _new(cls, *args, **kwargs):
+        # return a request from the pool, reinitialized, or a new one
+        with _shared_lock:
+            req = cls._pool.pop() if cls._pool else None
+        if req is None:
+            return cls(*args, **kwargs)
+        req.__init__(*args, **kwargs)
+        return req
+
+    def _release(self):
+        # return this request to the pool once its response has been
+        # written, dropping references to its data
+        if self.detached or len(self._pool) >= self.pool_size:
+            return
+        self.app = self.sock = self._stream = self._body = None
+        self._headers = self._raw_headers = self._raw_headers_lower = None
+        self.args = self._cookies = self._json = self._form = None
+        self._g = self.url_args = None
+        self.after_request_handlers = ()
+        with _shared_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(self)
 
     @staticmethod
-    def create(app, client_stream, client_addr, client_sock=None):
+    def create(app, client_stream, client_addr, client_sock=None,
+               started=None):
         """Create a request object.
 
 
@@ -377,28 +560,152 @@ class Request():
                               be read.
         :param client_addr: The address of the client, as a tuple.
         :param client_sock: The low-level socket associated with the request.
+        :param started: The ``ticks_ms()`` value from which to measure
+                        :attr:`request_deadline`. If omitted, the deadline is
+                        measured from the arrival of the request line.
 
         This method returns a newly created ``Request`` object.
         """
+        if hasattr(client_sock, 'recv'):
+            return Request._create_from_socket(
+                app, client_stream, client_addr, client_sock, started)
+
         # request line
-        line = Request._safe_readline(client_stream).strip().decode()
+        line = Request._safe_readline(client_stream, client_sock, started)
+        head_length = len(line)
+        line = line.strip().decode()
         if not line:
             return None
+        if started is None:
+            started = ticks_ms()
         method, url, http_version = line.split()
         http_version = http_version.split('/', 1)[1]
 
         # headers
         headers = NoCaseDict()
         while True:
-            line = Request._safe_readline(client_stream).strip().decode()
+            line = Request._safe_readline(
+                client_stream, client_sock, started)
+            head_length += len(line)
+            line = line.strip().decode()
             if line == '':
                 break
             header, value = line.split(':', 1)
             value = value.strip()
             headers[header] = value
 
-        return Request(app, client_addr, method, url, http_version, headers,
-                       stream=client_stream, sock=client_sock)
+        req = Request._new(app, client_addr, method, url, http_version,
+                           headers, stream=client_stream, sock=client_sock)
+        req.started = started
+        req.head_length = head_length
+        return req
+
+    @staticmethod
+    def _create_from_socket(app, client_stream, client_addr, client_sock,
+                            started):
+        # Fast path: receive the whole head with as few recv() calls as
+        # possible (usually one) and split it once, instead of reading and
+        # decoding it line by line. Headers are only parsed if the
+        # application asks for them.
+        if isinstance(client_stream, _PrefixedStream):
+            conn = client_stream
+        else:
+            conn = _PrefixedStream(b'', client_stream, client_sock)
+        data = conn.prefix
+        conn.prefix = b''
+        if data and started is None:
+            started = ticks_ms()
+        while True:
+            end, body_start = _find_head_end(data)
+            if end >= 0:
+                break
+            if len(data) >= Request.max_head_length:
+                raise ValueError('request head too long')
+            if started is not None and Request.request_deadline:
+                remaining = Request.request_deadline - \
+                    ticks_diff(ticks_ms(), started) / 1000
+                if remaining <= 0:
+                    raise OSError(errno.ETIMEDOUT, 'request deadline exceeded')
+                client_sock.settimeout(
+                    min(Request.socket_read_timeout or remaining, remaining))
+            chunk = client_sock.recv(Request.max_head_length - len(data))
+            if not chunk:
+                return None  # the client closed the connection
+            data = data + chunk if data else chunk
+            if started is None:
+                started = ticks_ms()
+        head = data[:end]
+        if body_start - end == 2:
+            # bare LF line endings
+            head = head.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        line_end = head.find(b'\r\n')
+        if line_end < 0:
+            line_end = len(head)
+        method, url, http_version = head[:line_end].decode().split()
+        http_version = http_version.split('/', 1)[1]
+        # whatever arrived after the head (part of the body, or pipelined
+        # requests) is read from the connection before the socket
+        conn.prefix = data[body_start:]
+        req = Request._new(app, client_addr, method, url, http_version,
+                           None, stream=conn, sock=client_sock,
+                           raw_headers=head[line_end + 2:])
+        req.started = ticks_ms() if started is None else started
+        req.head_length = body_start
+        return req
+
+    def _header(self, name):
+        # return the value of one header, given its lowercase name, without
+        # parsing all the headers if they haven't been yet
+        if self._headers is not None:
+            return self._headers.get(name)
+        if not self._raw_headers:
+            return None
+        if self._raw_headers_lower is None:
+            self._raw_headers_lower = b'\r\n' + self._raw_headers.lower()
+        start = self._raw_headers_lower.find(b'\r\n' + name.encode() + b':')
+        if start < 0:
+            return None
+        start += len(name) + 3
+        end = self._raw_headers_lower.find(b'\r\n', start)
+        # the lowercase copy is offset by the two bytes prepended to it
+        return self._raw_headers[
+            start - 2:end - 2 if end >= 0 else None].decode().strip()
+
+    @property
+    def headers(self):
+        """A dictionary with the headers included in the request."""
+        if self._headers is None:
+            self._headers = NoCaseDict()
+            for line in self._raw_headers.split(b'\r\n'):
+                if line:
+                    header, value = line.decode().split(':', 1)
+                    self._headers[header] = value.strip()
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    @property
+    def cookies(self):
+        """A dictionary with the cookies included in the request."""
+        if self._cookies is None:
+            self._cookies = {}
+            cookie_header = self._header('cookie')
+            if cookie_header:
+                for cookie in cookie_header.split(';'):
+                    name, value = cookie.strip().split('=', 1)
+                    self._cookies[name] = value
+        return self._cookies
+
+    @cookies.setter
+    def cookies(self, cookies):
+        self._cookies = cookies
+
+    @property
+    def content_type(self):
+        """The parsed ``Content-Type`` header."""
+        return self._header('content-type')
 
     def _parse_urlencoded(self, urlencoded):
         data = MultiDict()
@@ -490,11 +797,48 @@ class Request():
         Note that the function is not called if the request handler raises an
         exception and an error response is returned instead.
         """
+        if not self.after_request_handlers:
+            self.after_request_handlers = []
         self.after_request_handlers.append(f)
         return f
 
+    @property
+    def g(self):
+        """A general purpose container for applications to store data during
+        the life of the request."""
+        if self._g is None:
+            self._g = Request.G()
+        return self._g
+
+    def detach(self):
+        """Take ownership of the client connection. The server will not
+        write a response to it or close it once the handler returns, so the
+        application can keep it open and write to it later, for example to
+        stream events. The handler should return
+        ``Response.already_handled``.
+
+        This method returns the stream associated with the connection.
+
+        Example::
+
+            @app.route('/stream')
+            def stream(request):
+                subscribers.append(request.detach())
+                return Response.already_handled
+        """
+        self.detached = True
+        return self._stream
+
     @staticmethod
-    def _safe_readline(stream):
+    def _safe_readline(stream, sock=None, started=None):
+        if started is not None and Request.request_deadline:
+            remaining = Request.request_deadline - \
+                ticks_diff(ticks_ms(), started) / 1000
+            if remaining <= 0:
+                raise OSError(errno.ETIMEDOUT, 'request deadline exceeded')
+            if hasattr(sock, 'settimeout'):  # pragma: no branch
+                sock.settimeout(min(Request.socket_read_timeout or remaining,
+                                    remaining))
         line = stream.readline(Request.max_readline + 1)
         if len(line) > Request.max_readline:
             raise ValueError('line too long')
@@ -516,6 +860,9 @@ class Response():
                    default is "OK" for responses with a 200 status code and
                    "N/A" for any other status codes.
     """
+    __slots__ = ('status_code', 'headers', 'reason', 'body', 'is_head',
+                 'http_version', '_pooled', '_file_buffer')
+
     types_map = {
         'css': 'text/css',
         'gif': 'image/gif',
@@ -526,8 +873,17 @@ class Response():
         'png': 'image/png',
         'txt': 'text/plain',
     }
+    #: The size of the chunks in which file-like bodies are read and sent.
+    #: Larger chunks mean fewer writes, at the cost of a larger buffer.
+    #:
+    #: Example::
+    #:
+    #:    Response.send_file_buffer_size = 2048
     send_file_buffer_size = 1024
 
+    # buffer for reading file-like bodies, reused by one response at a time
+    _send_file_buffer = None
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -540,12 +896,46 @@ class Response():
     #: written to the client. Used to exit WebSocket connections cleanly.
     already_handled = None
 
+    #: Byte-sequence bodies up to this size are written in the same call as
+    #: the status line and headers, so that small responses are sent in a
+    #: single TCP segment.
+    coalesce_body_size = 1460
+
+    #: Headers whose encoded lines are cached by value, as they take few
+    #: distinct values. The status line is always cached.
+    cached_headers = ('Content-Type', 'Connection', 'Keep-Alive',
+                      'Cache-Control', 'Content-Encoding')
+
+    #: Maximum number of encoded lines to cache.
+    max_cached_lines = 32
+
+    _line_cache = {}
+
+    #: Specify how many response objects created by the application instance
+    #: are kept after they are written, to be reused for later responses
+    #: instead of allocating new ones. Responses constructed by route
+    #: handlers are never pooled. The default is 0, which disables the pool.
+    #:
+    #: Example::
+    #:
+    #:    Response.pool_size = 2
+    pool_size = 0
+
+    _pool = []
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
+        self._pooled = False
+        self._file_buffer = None
+        self._init(body, status_code, headers, reason, NoCaseDict())
+
+    def _init(self, body, status_code, headers, reason, header_dict):
         if body is None and status_code == 200:
             body = ''
             status_code = 204
         self.status_code = status_code
-        self.headers = NoCaseDict(headers or {})
+        self.headers = header_dict
+        if headers:
+            header_dict.update(headers)
         self.reason = reason
         if isinstance(body, (dict, list)):
             self.body = json.dumps(body).encode()
@@ -556,6 +946,41 @@ class Response():
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
+        self.http_version = '1.0'
+
+    @classmethod
+    def _new(cls, body='', status_code=200, headers=None, reason=None):
+        # return a response from the pool, reinitialized with its headers
+        # dictionary cleared, or a new one
+        with _shared_lock:
+            res = cls._pool.pop() if cls._pool else None
+        if res is None:
+            res = cls(body, status_code, headers, reason)
+            res._pooled = True
+        else:
+            res.headers.clear()
+            res._init(body, status_code, headers, reason, res.headers)
+        return res
+
+    def _release(self):
+        # return this response to the pool once it has been written
+        self._release_buffer()
+        if not self._pooled or len(self._pool) >= self.pool_size:
+            return
+        self.body = None
+        with _shared_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(self)
+
+    def _release_buffer(self):
+        # hand the buffer taken by _readinto_iter() back for the next
+        # response; done here rather than in a finally clause of the
+        # generator, as MicroPython does not run that when the generator is
+        # abandoned, i.e. because the client went away mid-body
+        if self._file_buffer is not None:
+            with _shared_lock:
+                Response._send_file_buffer = self._file_buffer
+            self._file_buffer = None
 
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False):
@@ -602,42 +1027,89 @@ class Response():
             if 'charset=' not in self.headers['Content-Type']:
                 self.headers['Content-Type'] += '; charset=UTF-8'
 
-    def write(self, stream):
-        self.complete()
-
-        # status code
+    def _cached_line(self, key, line):
+        encoded = self._line_cache.get(key)
+        if encoded is None:
+            encoded = line.encode()
+            if len(self._line_cache) < self.max_cached_lines:
+                self._line_cache[key] = encoded
+        return encoded
+
+    def _head(self):
+        """Return the status line and headers of the response, encoded and
+        terminated by the blank line that precedes the body."""
         reason = self.reason if self.reason is not None else \
             ('OK' if self.status_code == 200 else 'N/A')
-        stream.write('HTTP/1.0 {status_code} {reason}\r\n'.format(
-            status_code=self.status_code, reason=reason).encode())
-
-        # headers
+        parts = [self._cached_line(
+            (self.http_version, self.status_code, reason),
+            'HTTP/{version} {status_code} {reason}\r\n'.format(
+                version=self.http_version, status_code=self.status_code,
+                reason=reason))]
         for header, value in self.headers.items():
             values = value if isinstance(value, list) else [value]
             for value in values:
-                stream.write('{header}: {value}\r\n'.format(
-                    header=header, value=value).encode())
-        stream.write(b'\r\n')
+                line = '{header}: {value}\r\n'.format(
+                    header=header, value=value)
+                if header in self.cached_headers:
+                    parts.append(self._cached_line((header, value), line))
+                else:
+                    parts.append(line.encode())
+        parts.append(b'\r\n')
+        return b''.join(parts)
+
+    def _coalesced_head(self):
+        """Return the encoded status line and headers, followed by the body
+        when it is small enough to be written with them, and whether the
+        body was included."""
+        self.complete()
+        head = self._head()
+        if self.is_head:
+            return head, True
+        if isinstance(self.body, bytes) and \
+                len(self.body) <= self.coalesce_body_size:
+            return head + self.body, True
+        return head, False
 
-        # body
-        if not self.is_head:
-            can_flush = hasattr(stream, 'flush')
+    def write(self, stream):
+        """Write the response to a stream, and return the number of bytes
+        written."""
+        data, done = self._coalesced_head()
+        if done:
             try:
-                for body in self.body_iter():
-                    if isinstance(body, str):  # pragma: no cover
-                        body = body.encode()
-                    stream.write(body)
-                    if can_flush:  # pragma: no cover
-                        stream.flush()
+                stream.write(data)
+                if hasattr(stream, 'flush'):  # pragma: no cover
+                    stream.flush()
             except OSError as exc:  # pragma: no cover
-                if exc.errno in MUTED_SOCKET_ERRORS:
-                    pass
-                else:
+                if exc.errno not in MUTED_SOCKET_ERRORS:
                     raise
+            return len(data)
+        stream.write(data)
+        written = len(data)
+
+        # body
+        can_flush = hasattr(stream, 'flush')
+        try:
+            for body in self.body_iter():
+                if isinstance(body, str):  # pragma: no cover
+                    body = body.encode()
+                stream.write(body)
+                written += len(body)
+                if can_flush:  # pragma: no cover
+                    stream.flush()
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+        finally:
+            self._release_buffer()
+        return written
 
     def body_iter(self):
         if self.body:
-            if hasattr(self.body, 'read'):
+            if hasattr(self.body, 'readinto'):
+                yield from self._readinto_iter()
+            elif hasattr(self.body, 'read'):
                 while True:
                     buf = self.body.read(self.send_file_buffer_size)
                     if len(buf):
@@ -651,6 +1123,28 @@ class Response():
             else:
                 yield self.body
 
+    def _readinto_iter(self):
+        # read the body into a reused buffer and yield views of it, so that
+        # sending a file does not allocate a bytes object per chunk; each
+        # chunk must be written before the next one is requested; the
+        # buffer is handed back by _release_buffer()
+        size = self.send_file_buffer_size
+        with _shared_lock:
+            buf = Response._send_file_buffer
+            Response._send_file_buffer = None  # in use
+        if buf is None or len(buf) != size:
+            buf = bytearray(size)
+        self._file_buffer = buf
+        mv = memoryview(buf)
+        while True:
+            n = self.body.readinto(buf)
+            if n:
+                yield mv if n == size else mv[:n]
+            if not n or n < size:
+                break
+        if hasattr(self.body, 'close'):  # pragma: no cover
+            self.body.close()
+
     @classmethod
     def redirect(cls, location, status_code=302):
         """Return a redirect response.
@@ -724,6 +1218,9 @@ class URLPattern():
         self.url_pattern = url_pattern
         self.pattern = ''
         self.args = []
+        #: Literal path segments, with ``None`` for single-segment arguments;
+        #: ``None`` if an argument can span segments (``path`` or ``re:``)
+        self.segments = []
         use_regex = False
         for segment in url_pattern.lstrip('/').split('/'):
             if segment and segment[0] == '<':
@@ -741,15 +1238,21 @@ class URLPattern():
                     pattern = '-?\\d+'
                 elif type_ == 'path':
                     pattern = '.+'
+                    self.segments = None
                 elif type_.startswith('re:'):
                     pattern = type_[3:]
+                    self.segments = None
                 else:
                     raise ValueError('invalid URL segment type')
                 use_regex = True
                 self.pattern += '/({pattern})'.format(pattern=pattern)
                 self.args.append({'type': type_, 'name': name})
+                if self.segments is not None:
+                    self.segments.append(None)
             else:
                 self.pattern += '/{segment}'.format(segment=segment)
+                if self.segments is not None:
+                    self.segments.append(segment)
         if use_regex:
             self.pattern = re.compile('^' + self.pattern + '$')
 
@@ -797,6 +1300,8 @@ class Microdot():
 
     def __init__(self):
         self.url_map = []
+        self._router_size = -1
+        self.idle_handlers = []
         self.before_request_handlers = []
         self.after_request_handlers = []
         self.after_error_request_handlers = []
@@ -805,6 +1310,85 @@ class Microdot():
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
+        #: How often, in seconds, the idle handlers run while the server is
+        #: waiting for connections. Only used when idle handlers are
+        #: registered.
+        self.idle_interval = 0.1
+        #: How long, in seconds, a persistent (keep-alive) connection is kept
+        #: open waiting for its next request. Set to 0 to close every
+        #: connection after one response.
+        self.keep_alive_timeout = 65
+        #: Maximum number of persistent connections kept open at once. Once
+        #: reached, further connections are closed after one response.
+        self.max_keep_alive_connections = 2
+        #: Number of connections currently kept open for further requests.
+        self.keep_alive_connections = 0
+        # persistent connections waiting for their next request in the sync
+        # concurrency mode, as [sock, stream, addr, ticks_ms of last use]
+        self._idle_conns = []
+        #: Number of worker threads that handle connections in the threaded
+        #: concurrency mode. Set to 0 to start a new thread per connection.
+        self.worker_threads = 4
+        #: Maximum number of accepted connections waiting for a free worker.
+        #: Connections accepted while the queue is full are closed right away.
+        self.worker_queue_size = 8
+        #: Number of workers currently handling a connection.
+        self.workers_busy = 0
+        #: Total number of connections handed to the worker pool.
+        self.worker_queued_total = 0
+        #: Total number of connections closed because the queue was full.
+        self.worker_rejected_total = 0
+        #: Total milliseconds connections spent waiting for a worker.
+        self.worker_wait_ms_total = 0
+        #: Accepted connections waiting for a free worker, as (sock, addr,
+        #: ticks_ms when queued) tuples.
+        self.work_queue = []
+        self._work_cond = None
+        #: Maximum number of connections being served, waiting for a worker
+        #: or kept open for further requests at once. Further connections get
+        #: an immediate ``503`` response. Set to 0 for no limit. The limit
+        #: has no effect in the sync concurrency mode, which serves one
+        #: connection at a time and keeps at most
+        #: ``max_keep_alive_connections`` others open.
+        self.max_connections = 4
+        #: Client IP addresses, such as the Prometheus server's, that are
+        #: admitted even when the server is saturated and are served ahead of
+        #: other connections waiting for a worker.
+        self.priority_addresses = []
+        #: Seconds clients are asked to wait, in the ``Retry-After`` header of
+        #: ``503`` responses, before trying again.
+        self.retry_after = 5
+        #: Number of connections currently admitted.
+        self.connections_active = 0
+        # guards the connection counters in the threaded concurrency mode
+        self._count_lock = None
+        #: Total number of connections rejected with a ``503`` response.
+        self.connections_shed_total = 0
+        self._shed_response = b''
+        #: The ``SSLContext`` connections are wrapped with, if serving TLS.
+        #: The same context is used for every connection, so that the
+        #: session tickets or cached sessions it issues let returning
+        #: clients resume their sessions with an abbreviated handshake.
+        self.ssl = None
+        #: Number of completed TLS handshakes.
+        self.tls_handshakes_total = 0
+        #: Number of TLS handshakes that resumed an earlier session, where
+        #: the TLS implementation reports it.
+        self.tls_sessions_resumed_total = 0
+        #: Number of failed TLS handshakes.
+        self.tls_handshake_failures_total = 0
+        #: Total, in milliseconds, of the duration of completed TLS
+        #: handshakes.
+        self.tls_handshake_ms_total = 0
+        #: Duration, in milliseconds, of the slowest TLS handshake.
+        self.tls_handshake_ms_max = 0
+        #: An object whose ``request_done()`` method is called after each
+        #: response is written, with the request, the response, the number
+        #: of bytes written, and the ``ticks_ms()`` values when the
+        #: connection was accepted (or, on a persistent connection, when the
+        #: request started to arrive), when the request was dispatched, when
+        #: the response started to be written, and when it was written.
+        self.stats = None
 
     def route(self, url_pattern, methods=None):
         """Decorator that is used to register a function as a request handler
@@ -947,6 +1531,22 @@ class Microdot():
         self.before_request_handlers.append(f)
         return f
 
+    def idle(self, f):
+        """Decorator to register a function to run periodically from the
+        server's listening loop, between connections and at least every
+        :attr:`idle_interval` seconds. The decorated function takes no
+        arguments, and must return quickly, as no connections are accepted
+        while it runs.
+
+        Example::
+
+            @app.idle
+            def func():
+                # ...
+        """
+        self.idle_handlers.append(f)
+        return f
+
     def after_request(self, f):
         """Decorator to register a function to run after each request is
         handled. The decorated function must take two arguments, the request
@@ -1065,7 +1665,10 @@ class Microdot():
         :param debug: If ``True``, the server logs debugging information. The
                       default is ``False``.
         :param ssl: An ``SSLContext`` instance or ``None`` if the server should
-                    not use TLS. The default is ``None``.
+                    not use TLS. The default is ``None``. Each connection is
+                    wrapped with it once it has been admitted, and the
+                    handshake is not repeated for further requests on a
+                    persistent connection.
 
         Example::
 
@@ -1093,21 +1696,173 @@ class Microdot():
         self.server.bind(addr)
         self.server.listen(5)
 
-        if ssl:
-            self.server = ssl.wrap_socket(self.server, server_side=True)
+        self.ssl = ssl
+        if self.idle_handlers:
+            self.server.settimeout(self.idle_interval)
+        self._shed_response = self._format_shed_response()
+        if concurrency_mode == 'threaded' and \
+                self._count_lock is None:  # pragma: no cover
+            self._count_lock = threading.Lock()
+        if concurrency_mode == 'threaded' and self.worker_threads and \
+                self._work_cond is None:  # pragma: no cover
+            self._work_cond = threading.Condition()
+            for _ in range(self.worker_threads):
+                threading.Thread(target=self._worker, daemon=True).start()
 
         while not self.shutdown_requested:
-            try:
-                sock, addr = self.server.accept()
-            except OSError as exc:  # pragma: no cover
-                if exc.errno == errno.ECONNABORTED:
-                    break
+            readable = None
+            if self._idle_conns:
+                readable = self._poll_idle_conns()
+            if readable is None or self.server in readable:
+                try:
+                    sock, addr = self.server.accept()
+                except OSError as exc:  # pragma: no cover
+                    if exc.errno == errno.ECONNABORTED:
+                        break
+                    elif isinstance(exc, socket_timeout_error) and \
+                            exc.errno in (None, errno.ETIMEDOUT, errno.EAGAIN):
+                        pass  # idle_interval elapsed with no connection
+                    else:
+                        print_exception(exc)
+                except Exception as exc:  # pragma: no cover
+                    print_exception(exc)
                 else:
+                    if self.idle_handlers:
+                        # accepted sockets inherit the listener's timeout on
+                        # some platforms
+                        sock.settimeout(None)
+                    self._admit(sock, addr)
+            for handler in self.idle_handlers:
+                try:
+                    handler()
+                except Exception as exc:  # pragma: no cover
                     print_exception(exc)
-            except Exception as exc:  # pragma: no cover
+
+    def _format_shed_response(self):
+        # preformatted, so that rejecting a connection costs no more than a
+        # single write
+        return ('HTTP/1.0 503 Service Unavailable\r\n'
+                'Retry-After: {retry_after}\r\n'
+                'Content-Length: 0\r\n'
+                'Connection: close\r\n\r\n').format(
+                    retry_after=self.retry_after).encode()
+
+    def _is_priority(self, addr):
+        return bool(addr) and addr[0] in self.priority_addresses
+
+    def _admit(self, sock, addr):
+        priority = self._is_priority(addr)
+        if self.max_connections and not priority and \
+                self.connections_active >= self.max_connections:
+            self._shed(sock)
+            return
+        self._add_connections(active=1)
+        self._hand_off(sock, addr, priority)
+
+    def _add_connections(self, active=0, keep_alive=0):
+        # update the connection counters, which worker threads change
+        # concurrently in the threaded concurrency mode
+        if self._count_lock is None:
+            self.connections_active += active
+            self.keep_alive_connections += keep_alive
+            return
+        with self._count_lock:  # pragma: no cover
+            self.connections_active += active
+            self.keep_alive_connections += keep_alive
+
+    def _shed(self, sock):
+        self.connections_shed_total += 1
+        try:
+            if hasattr(sock, 'settimeout'):  # pragma: no branch
+                sock.settimeout(0.1)
+            # consume the request, if it has arrived, so that closing the
+            # socket does not reset the connection before the client reads
+            # the response
+            sock.recv(Request.max_readline)
+        except OSError:  # pragma: no cover
+            pass
+        if not self.ssl:
+            # a TLS client can't read a response sent before the handshake,
+            # and shedding must not cost one; it only sees the connection
+            # close
+            try:
+                if hasattr(sock, 'write'):  # pragma: no cover
+                    sock.write(self._shed_response)
+                else:
+                    sock.send(self._shed_response)
+            except OSError:  # pragma: no cover
+                pass
+        sock.close()
+
+    def _hand_off(self, sock, addr, priority=False):
+        if self._work_cond is None:
+            create_thread(self.handle_request, sock, addr, ticks_ms())
+            return
+        with self._work_cond:  # pragma: no cover
+            if priority:
+                self.work_queue.insert(0, (sock, addr, ticks_ms()))
+            elif len(self.work_queue) >= self.worker_queue_size:
+                self.worker_rejected_total += 1
+                priority = None
+            else:
+                self.work_queue.append((sock, addr, ticks_ms()))
+            if priority is not None:
+                self.worker_queued_total += 1
+                self._work_cond.notify()
+                return
+        # shed outside the lock, as it waits briefly for the request
+        self._add_connections(active=-1)
+        self._shed(sock)
+
+    def _worker(self):  # pragma: no cover
+        while True:
+            with self._work_cond:
+                while not self.work_queue:
+                    self._work_cond.wait()
+                sock, addr, queued = self.work_queue.pop(0)
+                self.worker_wait_ms_total += ticks_diff(ticks_ms(), queued)
+                self.workers_busy += 1
+            try:
+                self.handle_request(sock, addr, queued)
+            except Exception as exc:
                 print_exception(exc)
+            with self._work_cond:
+                self.workers_busy -= 1
+
+    def _poll_idle_conns(self):
+        # wait for a new connection or a request on a persistent connection,
+        # serve the latter, and close those that have been idle too long
+        timeout = self.idle_interval if self.idle_handlers else 1
+        # connections with a pipelined request already received won't
+        # become readable for it
+        pending = [c for c in self._idle_conns
+                   if getattr(c[1], 'prefix', None)]
+        if pending:
+            timeout = 0
+        try:
+            readable = select.select(
+                [self.server] + [c[0] for c in self._idle_conns], [], [],
+                timeout)[0]
+        except OSError as exc:  # pragma: no cover
+            print_exception(exc)
+            readable = []
+        now = ticks_ms()
+        for conn in list(self._idle_conns):
+            if conn[0] in readable or conn in pending:
+                self._idle_conns.remove(conn)
+                keep = self._serve(conn[0], conn[1], conn[2], False)
+                if keep:
+                    conn[3] = ticks_ms()
+                    self._idle_conns.append(conn)
+                    continue
+            elif ticks_diff(now, conn[3]) >= self.keep_alive_timeout * 1000:
+                self._idle_conns.remove(conn)
+                keep = False
             else:
-                create_thread(self.handle_request, sock, addr)
+                continue
+            self._add_connections(keep_alive=-1)
+            self._close(conn[0], conn[1], keep is None)
+        return readable
 
     def shutdown(self):
         """Request a server shutdown. The server will then exit its request
@@ -1131,19 +1886,22 @@ class Microdot():
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
+        req.url_args = None
+        for i in self._route_candidates(req.path):
+            route_methods, route_pattern, route_handler = self.url_map[i]
+            url_args = route_pattern.match(req.path)
+            if url_args is not None:
+                req.url_args = url_args
                 if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+                    req.route = route_pattern.url_pattern
+                    return route_handler
+                f = 405
         return f
 
     def default_options_handler(self, req):
         allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
+        for i in self._route_candidates(req.path):
+            route_methods, route_pattern, route_handler = self.url_map[i]
             if route_pattern.match(req.path) is not None:
                 allow.extend(route_methods)
         if 'GET' in allow:
@@ -1151,28 +1909,248 @@ class Microdot():
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
-    def handle_request(self, sock, addr):
+    def _build_router(self):
+        """Index ``url_map`` for ``_route_candidates()``.
+
+        Each static path maps to the indexes of all routes that match it,
+        including argument routes. Routes whose arguments each match a single
+        path segment go in a trie of ``[literal children, argument child,
+        route indexes]`` nodes. Routes with ``path`` or ``re:`` arguments,
+        which can span segments, are candidates for every other path, so
+        they are merged into the route indexes of each trie node.
+        """
+        static = {}
+        trie = [{}, None, []]
+        spanning = []
+        for i, (methods, pattern, handler) in enumerate(self.url_map):
+            if isinstance(pattern.pattern, str):
+                static[pattern.pattern] = []
+            elif pattern.segments is None:
+                spanning.append(i)
+            else:
+                node = trie
+                for segment in pattern.segments:
+                    if segment is None:
+                        if node[1] is None:
+                            node[1] = [{}, None, []]
+                        node = node[1]
+                    else:
+                        node = node[0].setdefault(segment, [{}, None, []])
+                node[2].append(i)
+        for path, candidates in static.items():
+            for i, (methods, pattern, handler) in enumerate(self.url_map):
+                if pattern.match(path) is not None:
+                    candidates.append(i)
+        nodes = [trie]
+        while nodes:
+            node = nodes.pop()
+            if node[2] and spanning:
+                node[2] = sorted(node[2] + spanning)
+            nodes.extend(node[0].values())
+            if node[1] is not None:
+                nodes.append(node[1])
+        self._static_routes = static
+        self._route_trie = trie
+        self._spanning_routes = spanning
+        self._router_size = len(self.url_map)
+
+    def _route_candidates(self, path):
+        """Return the indexes of the routes in ``url_map`` that may match
+        ``path``, in order.
+
+        The index is rebuilt whenever the number of routes changes, as routes
+        may be appended to ``url_map`` directly.
+        """
+        if self._router_size != len(self.url_map):
+            self._build_router()
+        candidates = self._static_routes.get(path)
+        if candidates is not None:
+            return candidates
+        node = self._route_trie
+        nodes = None
+        for segment in path.lstrip('/').split('/'):
+            if nodes is None:
+                # single node so far, the common case
+                child = node[0].get(segment)
+                arg = node[1] if segment else None
+                if child is None:
+                    if arg is None:
+                        return self._spanning_routes
+                    node = arg
+                elif arg is None:
+                    node = child
+                else:
+                    nodes = [child, arg]
+                continue
+            next_nodes = []
+            for node in nodes:
+                child = node[0].get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                if segment and node[1] is not None:
+                    next_nodes.append(node[1])
+            if not next_nodes:
+                return self._spanning_routes
+            nodes = next_nodes
+        if nodes is None:
+            return node[2] or self._spanning_routes
+        candidates = set(self._spanning_routes)
+        for node in nodes:
+            candidates.update(node[2])
+        return sorted(candidates)
+
+    def handle_request(self, sock, addr, accepted=None):
         if Request.socket_read_timeout and \
                 hasattr(sock, 'settimeout'):  # pragma: no cover
             sock.settimeout(Request.socket_read_timeout)
+        if self.ssl:
+            sock = self._tls_handshake(sock)
+            if sock is None:
+                self._add_connections(active=-1)
+                return
         if not hasattr(sock, 'readline'):  # pragma: no cover
             stream = sock.makefile("rwb")
         else:
             stream = sock
+        if hasattr(sock, 'recv'):
+            # keeps bytes received past the end of a request for the next
+            stream = _PrefixedStream(b'', stream, sock)
+
+        keep = self._serve(sock, stream, addr, True, accepted)
+        if not keep:
+            self._close(sock, stream, keep is None)
+            return
+        self._add_connections(keep_alive=1)
+        if concurrency_mode == 'sync':
+            # there is no thread to wait for the next request on; the
+            # accept loop watches the connection instead
+            self._idle_conns.append([sock, stream, addr, ticks_ms()])
+            return
+        while keep:
+            if hasattr(sock, 'settimeout'):  # pragma: no branch
+                sock.settimeout(self.keep_alive_timeout)
+            keep = self._serve(sock, stream, addr, False)
+        self._add_connections(keep_alive=-1)
+        self._close(sock, stream, keep is None)
+
+    def _tls_handshake(self, sock):
+        # wrap an admitted connection with TLS, recording how long the
+        # handshake took; returns None, having closed the connection, if the
+        # handshake fails
+        started = ticks_ms()
+        try:
+            tls_sock = self.ssl.wrap_socket(sock, server_side=True)
+        except Exception as exc:
+            self.tls_handshake_failures_total += 1
+            if self.debug:  # pragma: no cover
+                print_exception(exc)
+            sock.close()
+            return None
+        self.tls_handshake_done(ticks_diff(ticks_ms(), started),
+                                getattr(tls_sock, 'session_reused', False))
+        return tls_sock
+
+    def tls_handshake_done(self, ms, resumed=False):
+        """Record a completed TLS handshake in the ``tls_*`` counters.
 
+        :param ms: The duration of the handshake in milliseconds, or ``None``
+                   if it is not known.
+        :param resumed: Whether the handshake resumed an earlier session.
+        """
+        self.tls_handshakes_total += 1
+        if resumed:
+            self.tls_sessions_resumed_total += 1
+        if ms is not None:
+            self.tls_handshake_ms_total += ms
+            if ms > self.tls_handshake_ms_max:
+                self.tls_handshake_ms_max = ms
+
+    def _serve(self, sock, stream, addr, first, accepted=None):
+        # serve one request; returns True if the connection should be kept
+        # open for another request, None if the handler detached it, or
+        # False if it should be closed
         req = None
         res = None
+        dispatched = rendered = None
         try:
-            req = Request.create(self, stream, addr, sock)
+            req = Request.create(self, stream, addr, sock,
+                                 ticks_ms() if first else None)
+            if req is None and not first:
+                return False  # the client closed the persistent connection
+            dispatched = ticks_ms()
             res = self.dispatch_request(req)
         except socket_timeout_error as exc:  # pragma: no cover
             if exc.errno and exc.errno != errno.ETIMEDOUT:
                 print_exception(exc)  # not a timeout
         except Exception as exc:  # pragma: no cover
             print_exception(exc)
+        if req and req.detached:
+            return None
+        keep = False
         try:
             if res and res != Response.already_handled:  # pragma: no branch
-                res.write(stream)
+                keep = self._keep_alive(req, res, first)
+                rendered = ticks_ms()
+                written = res.write(stream)
+                if keep and hasattr(stream, 'flush'):  # pragma: no cover
+                    stream.flush()
+                if self.stats is not None:
+                    self.stats.request_done(
+                        req, res, written,
+                        accepted if first and accepted is not None else
+                        (req.started if req else dispatched),
+                        dispatched, rendered, ticks_ms())
+        except OSError as exc:  # pragma: no cover
+            keep = False
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                print_exception(exc)
+        except Exception as exc:  # pragma: no cover
+            keep = False
+            print_exception(exc)
+        if self.debug and req:  # pragma: no cover
+            print('{method} {path} {status_code}'.format(
+                method=req.method, path=req.path,
+                status_code=res.status_code))
+        self._release(req, res)
+        return keep
+
+    def _release(self, req, res):
+        # return the request and response objects to their pools, if enabled
+        if req:
+            req._release()
+        if res:
+            res._release()
+
+    def _keep_alive(self, req, res, first):
+        # decide whether the connection persists after this response, and
+        # set the response's HTTP version and Connection header to match
+        keep = False
+        if req:
+            res.http_version = '1.1' if req.http_version == '1.1' else '1.0'
+            connection = (req._header('connection') or '').lower()
+            keep = connection == 'keep-alive' or (
+                req.http_version == '1.1' and connection != 'close')
+            # a body the handler did not read would be taken for the next
+            # request on the connection, so only keep it if there was none
+            # or it was read in full
+            keep = keep and (not req.content_length or req.body_used)
+        # only responses of known length can be delimited without closing
+        keep = keep and isinstance(res.body, bytes) and \
+            self.keep_alive_timeout > 0 and not self.shutdown_requested and \
+            (not first or self.keep_alive_connections <
+             self.max_keep_alive_connections)
+        res.headers['Connection'] = 'keep-alive' if keep else 'close'
+        return keep
+
+    def _close(self, sock, stream, detached=False):
+        # release an admitted connection, closing it unless a handler has
+        # taken ownership of it
+        self._add_connections(active=-1)
+        if detached:
+            return
+        try:
             stream.close()
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS:
@@ -1185,10 +2163,6 @@ class Microdot():
             sock.close()
         if self.shutdown_requested:  # pragma: no cover
             self.server.close()
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
 
     def dispatch_request(self, req):
         after_request_handled = False
@@ -1217,16 +2191,16 @@ class Microdot():
                             else:
                                 status_code = 200
                                 headers = res[1]
-                            res = Response(body, status_code, headers)
+                            res = Response._new(body, status_code, headers)
                         elif not isinstance(res, Response):
-                            res = Response(res)
+                            res = Response._new(res)
                         for handler in self.after_request_handlers:
                             res = handler(req, res) or res
                         for handler in req.after_request_handlers:
                             res = handler(req, res) or res
                         after_request_handled = True
                     elif isinstance(f, dict):
-                        res = Response(headers=f)
+                        res = Response._new(headers=f)
                     elif f in self.error_handlers:
                         res = self.error_handlers[f](req)
                     else:
@@ -1264,9 +2238,9 @@ class Microdot():
                 res = 'Bad request', 400
 
         if isinstance(res, tuple):
-            res = Response(*res)
+            res = Response._new(*res)
         elif not isinstance(res, Response):
-            res = Response(res)
+            res = Response._new(res)
         if not after_request_handled:
             for handler in self.after_error_request_handlers:
                 res = handler(req, res) or res
@@ -0,0 +1,571 @@
+"""
+microdot_asyncio
+----------------
+
+The ``microdot_asyncio`` module defines a few classes that help implement
+HTTP-based servers for MicroPython and standard Python that use ``asyncio``
+for concurrency, so that many connections can be served at once without a
+thread per connection.
+
+Applications use the ``Microdot`` class from this module instead of the one
+in ``microdot``. Route handlers, before and after request handlers and error
+handlers can be plain functions, as with the ``microdot`` module, or
+coroutines.
+"""
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from microdot import Microdot as BaseMicrodot
+from microdot import mro
+from microdot import NoCaseDict
+from microdot import Request as BaseRequest
+from microdot import Response as BaseResponse
+from microdot import print_exception
+from microdot import HTTPException
+from microdot import MUTED_SOCKET_ERRORS
+from microdot import ticks_ms, ticks_diff
+
+
+def _iscoroutine(coro):
+    return hasattr(coro, 'send') and hasattr(coro, 'throw')
+
+
+class _DetachedStream:
+    """A synchronous ``write()``/``close()`` interface over an asyncio stream
+    writer, returned by :meth:`Request.detach` so that code written for the
+    ``microdot`` module can keep writing to detached connections, for example
+    from idle handlers.
+
+    Written data is buffered by the stream writer until it is sent. A flush
+    that fails, or does not complete within the timeout set with
+    :meth:`settimeout`, closes the connection and makes later writes raise
+    ``OSError``, so a stalled client cannot make the buffer grow without
+    limit."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.timeout = None
+        self._draining = False
+        self._failed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def write(self, data):
+        if self._failed:
+            raise OSError(errno.ETIMEDOUT)
+        self.writer.write(data)
+
+    def flush(self):
+        if self._failed:
+            raise OSError(errno.ETIMEDOUT)
+        if not self._draining:
+            self._draining = True
+            asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            if self.timeout is None:
+                await self.writer.drain()
+            else:
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._failed = True
+            try:
+                self.writer.close()
+            except OSError:  # pragma: no cover
+                pass
+        self._draining = False
+
+    def close(self):
+        self.writer.close()
+
+
+class Request(BaseRequest):
+    __slots__ = ()
+    _pool = []  # not shared with the synchronous request class
+
+    @staticmethod
+    async def create(app, client_reader, client_writer, client_addr,
+                     started=None):
+        """Create a request object.
+
+        :param app: The Microdot application instance.
+        :param client_reader: An input stream from where the request data can
+                              be read.
+        :param client_writer: The output stream of the connection.
+        :param client_addr: The address of the client, as a tuple.
+        :param started: The ``ticks_ms()`` value from which to measure
+                        :attr:`request_deadline`. If omitted, the deadline is
+                        measured from the arrival of the request line.
+
+        This method is a coroutine. It returns a newly created ``Request``
+        object.
+        """
+        # request line
+        line = await Request._safe_readline(client_reader, started)
+        head_length = len(line)
+        line = line.strip().decode()
+        if not line:
+            return None
+        if started is None:
+            started = ticks_ms()
+        method, url, http_version = line.split()
+        http_version = http_version.split('/', 1)[1]
+
+        # headers
+        headers = NoCaseDict()
+        content_length = 0
+        while True:
+            line = await Request._safe_readline(client_reader, started)
+            head_length += len(line)
+            line = line.strip().decode()
+            if line == '':
+                break
+            header, value = line.split(':', 1)
+            value = value.strip()
+            headers[header] = value
+            if header.lower() == 'content-length':
+                content_length = int(value)
+
+        # body
+        body = b''
+        if content_length and content_length <= Request.max_body_length:
+            # bounded by request_deadline, so that a client sending the body
+            # slowly cannot hold the connection before dispatch
+            body = await Request._before_deadline(
+                client_reader.readexactly(content_length), started)
+            stream = None
+        else:
+            # the application reads larger bodies with ``await
+            # request.stream.read()``
+            stream = client_reader
+
+        req = Request._new(app, client_addr, method, url, http_version,
+                           headers, body=body, stream=stream,
+                           sock=_DetachedStream(client_writer))
+        req.started = started
+        req.head_length = head_length
+        # the body has been read in full unless it was left in the stream
+        req.body_used = stream is None
+        return req
+
+    def detach(self):
+        """Take ownership of the client connection, as with
+        :meth:`microdot.Request.detach`. This method returns an object with
+        synchronous ``write()``, ``flush()`` and ``close()`` methods.
+        """
+        self.detached = True
+        return self.sock
+
+    @staticmethod
+    async def _before_deadline(coro, started=None):
+        # await the coroutine, raising asyncio.TimeoutError if it does not
+        # complete before request_deadline has passed since started
+        if started is None or not Request.request_deadline:
+            return await coro
+        remaining = Request.request_deadline - \
+            ticks_diff(ticks_ms(), started) / 1000
+        if remaining <= 0:
+            coro.close()
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(coro, remaining)
+
+    @staticmethod
+    async def _safe_readline(stream, started=None):
+        line = await Request._before_deadline(stream.readline(), started)
+        if len(line) > Request.max_readline:
+            raise ValueError('line too long')
+        return line
+
+
+class Response(BaseResponse):
+    """An HTTP response class.
+
+    :param body: The body of the response. If a dictionary or list is given,
+                 a JSON formatter is used to generate the body. If a file-like
+                 object or a generator is given, a streaming response is used.
+                 If a string is given, it is encoded from UTF-8. Else, the
+                 body should be a byte sequence.
+    :param status_code: The numeric HTTP status code of the response. The
+                        default is 200.
+    :param headers: A dictionary of headers to include in the response.
+    :param reason: A custom reason phrase to add after the status code. The
+                   default is "OK" for responses with a 200 status code and
+                   "N/A" for any other status codes.
+    """
+    __slots__ = ()
+    _pool = []  # not shared with the synchronous response class
+
+    async def write(self, stream):
+        data, done = self._coalesced_head()
+        written = 0
+
+        try:
+            stream.write(data)
+            await stream.drain()
+            written = len(data)
+
+            # body
+            if not done:
+                for body in self.body_iter():
+                    if isinstance(body, str):  # pragma: no cover
+                        body = body.encode()
+                    elif isinstance(body, memoryview):
+                        # the stream may hold on to the chunk until it is
+                        # sent, and file chunks share a reused buffer
+                        body = bytes(body)
+                    stream.write(body)
+                    await stream.drain()
+                    written += len(body)
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS or \
+                    exc.args[:1] == ('Connection lost',):
+                pass
+            else:
+                raise
+        finally:
+            self._release_buffer()
+        return written
+
+
+class Microdot(BaseMicrodot):
+    def __init__(self):
+        super().__init__()
+        self.background_tasks = []
+        try:
+            self._wake_flag = asyncio.ThreadSafeFlag()
+        except AttributeError:  # pragma: no cover
+            # CPython has no ThreadSafeFlag; only wake from the event loop
+            self._wake_flag = asyncio.Event()
+
+    def background(self, f):
+        """Decorator to register a coroutine function that is started as a
+        task alongside the server, for background work that shares the
+        server's event loop.
+
+        Example::
+
+            @app.background
+            async def sample():
+                while True:
+                    read_sensors()
+                    await asyncio.sleep_ms(100)
+        """
+        self.background_tasks.append(f)
+        return f
+
+    def wake(self):
+        """Run the idle handlers as soon as possible, instead of waiting for
+        ``idle_interval`` to elapse. This method can be called from an
+        interrupt handler."""
+        self._wake_flag.set()
+
+    async def start_server(self, host='0.0.0.0', port=5000, debug=False,
+                           ssl=None):
+        """Start the Microdot web server as a coroutine. This coroutine does
+        not normally return, as the server enters an endless listening loop.
+        The :func:`shutdown` function provides a method for terminating the
+        server gracefully.
+
+        :param host: The hostname or IP address of the network interface that
+                     will be listening for requests. A value of ``'0.0.0.0'``
+                     (the default) indicates that the server should listen for
+                     requests on all the available interfaces, and a value of
+                     ``127.0.0.1`` indicates that the server should listen
+                     for requests only on the internal networking interface of
+                     the host.
+        :param port: The port number to listen for requests. The default is
+                     port 5000.
+        :param debug: If ``True``, the server logs debugging information. The
+                      default is ``False``.
+        :param ssl: An ``SSLContext`` instance or ``None`` if the server should
+                    not use TLS. The default is ``None``. The event loop
+                    performs the handshakes, so completed ones are counted
+                    in the ``tls_*`` attributes, but they are not timed and
+                    failed ones are not counted.
+        """
+        self.debug = debug
+        self.shutdown_requested = False
+        self.ssl = ssl
+        self._shed_response = self._format_shed_response()
+
+        async def serve(reader, writer):
+            await self.handle_request(reader, writer)
+
+        if self.debug:  # pragma: no cover
+            print('Starting async server on {host}:{port}...'.format(
+                host=host, port=port))
+
+        if ssl:
+            self.server = await asyncio.start_server(serve, host, port,
+                                                     ssl=ssl)
+        else:
+            self.server = await asyncio.start_server(serve, host, port)
+        for f in self.background_tasks:
+            asyncio.create_task(f())
+        if self.idle_handlers:
+            asyncio.create_task(self._idle_loop())
+        await self.server.wait_closed()
+
+    def run(self, host='0.0.0.0', port=5000, debug=False, ssl=None):
+        """Start the web server. This function does not normally return, as
+        the server enters an endless listening loop. The :func:`shutdown`
+        function provides a method for terminating the server gracefully.
+
+        :param host: The hostname or IP address of the network interface that
+                     will be listening for requests.
+        :param port: The port number to listen for requests. The default is
+                     port 5000.
+        :param debug: If ``True``, the server logs debugging information. The
+                      default is ``False``.
+        :param ssl: An ``SSLContext`` instance or ``None`` if the server should
+                    not use TLS. The default is ``None``.
+        """
+        asyncio.run(self.start_server(host=host, port=port, debug=debug,
+                                      ssl=ssl))  # pragma: no cover
+
+    def shutdown(self):
+        self.shutdown_requested = True
+        self.server.close()
+
+    async def _idle_loop(self):
+        while not self.shutdown_requested:
+            try:
+                await asyncio.wait_for(self._wake_flag.wait(),
+                                       self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
+            if hasattr(self._wake_flag, 'clear'):  # pragma: no cover
+                self._wake_flag.clear()
+            for handler in self.idle_handlers:
+                try:
+                    await self._invoke_handler(handler)
+                except Exception as exc:  # pragma: no cover
+                    print_exception(exc)
+
+    async def handle_request(self, reader, writer):
+        accepted = ticks_ms()
+        if self.ssl:
+            try:
+                ssl_object = writer.get_extra_info('ssl_object')
+            except (KeyError, AttributeError):  # pragma: no cover
+                ssl_object = None  # not reported by uasyncio
+            self.tls_handshake_done(
+                None, getattr(ssl_object, 'session_reused', False))
+        if self.max_connections and \
+                self.connections_active >= self.max_connections and \
+                not self._is_priority(writer.get_extra_info('peername')):
+            self.connections_shed_total += 1
+            try:
+                # consume the request, if it has arrived, so that closing
+                # the socket does not reset the connection before the client
+                # reads the response
+                await asyncio.wait_for(reader.read(Request.max_readline), 0.1)
+            except (OSError, asyncio.TimeoutError):  # pragma: no cover
+                pass
+            try:
+                writer.write(self._shed_response)
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except OSError:  # pragma: no cover
+                pass
+            return
+        self.connections_active += 1
+        try:
+            await self._handle_connection(reader, writer, accepted)
+        finally:
+            self.connections_active -= 1
+
+    async def _handle_connection(self, reader, writer, accepted=None):
+        first = True
+        while True:
+            keep = await self._serve(reader, writer, first, accepted)
+            if not keep:
+                break
+            if first:
+                self.keep_alive_connections += 1
+                first = False
+        if not first:
+            self.keep_alive_connections -= 1
+        if keep is None:
+            return  # detached
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                print_exception(exc)
+        except Exception as exc:  # pragma: no cover
+            print_exception(exc)
+
+    async def _serve(self, reader, writer, first, accepted=None):
+        # serve one request; returns True if the connection should be kept
+        # open for another request, None if the handler detached it, or
+        # False if it should be closed
+        req = None
+        try:
+            if first:
+                req = await Request.create(
+                    self, reader, writer, writer.get_extra_info('peername'),
+                    ticks_ms())
+            else:
+                # wait up to keep_alive_timeout for the next request to
+                # start; request_deadline applies once it has
+                req = await asyncio.wait_for(
+                    Request.create(self, reader, writer,
+                                   writer.get_extra_info('peername')),
+                    self.keep_alive_timeout or None)
+        except asyncio.TimeoutError:  # pragma: no cover
+            pass
+        except OSError as exc:  # pragma: no cover
+            if exc.errno not in MUTED_SOCKET_ERRORS:
+                print_exception(exc)
+        except Exception as exc:  # pragma: no cover
+            print_exception(exc)
+        if req is None and not first:
+            return False  # the client closed or idled out the connection
+
+        dispatched = ticks_ms()
+        res = await self.dispatch_request(req)
+        if req and req.detached:
+            return None
+        keep = False
+        try:
+            if res != Response.already_handled:  # pragma: no branch
+                keep = self._keep_alive(req, res, first)
+                rendered = ticks_ms()
+                written = await Response.write(res, writer)
+                if self.stats is not None:
+                    self.stats.request_done(
+                        req, res, written,
+                        accepted if first and accepted is not None else
+                        (req.started if req else dispatched),
+                        dispatched, rendered, ticks_ms())
+        except OSError as exc:  # pragma: no cover
+            keep = False
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                print_exception(exc)
+        except Exception as exc:  # pragma: no cover
+            keep = False
+            print_exception(exc)
+        if self.debug and req:  # pragma: no cover
+            print('{method} {path} {status_code}'.format(
+                method=req.method, path=req.path,
+                status_code=res.status_code))
+        self._release(req, res)
+        return keep
+
+    async def dispatch_request(self, req):
+        after_request_handled = False
+        if req:
+            if req.content_length > req.max_content_length:
+                if 413 in self.error_handlers:
+                    res = await self._invoke_handler(
+                        self.error_handlers[413], req)
+                else:
+                    res = 'Payload too large', 413
+            else:
+                f = self.find_route(req)
+                try:
+                    res = None
+                    if callable(f):
+                        for handler in self.before_request_handlers:
+                            res = await self._invoke_handler(handler, req)
+                            if res:
+                                break
+                        if res is None:
+                            res = await self._invoke_handler(
+                                f, req, **req.url_args)
+                        if isinstance(res, tuple):
+                            body = res[0]
+                            if isinstance(res[1], int):
+                                status_code = res[1]
+                                headers = res[2] if len(res) > 2 else {}
+                            else:
+                                status_code = 200
+                                headers = res[1]
+                            res = Response._new(body, status_code, headers)
+                        elif not isinstance(res, BaseResponse):
+                            res = Response._new(res)
+                        for handler in self.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        for handler in req.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        after_request_handled = True
+                    elif isinstance(f, dict):
+                        res = Response._new(headers=f)
+                    elif f in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[f], req)
+                    else:
+                        res = 'Not found', f
+                except HTTPException as exc:
+                    if exc.status_code in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[exc.status_code], req)
+                    else:
+                        res = exc.reason, exc.status_code
+                except Exception as exc:
+                    print_exception(exc)
+                    exc_class = None
+                    res = None
+                    if exc.__class__ in self.error_handlers:
+                        exc_class = exc.__class__
+                    else:
+                        for c in mro(exc.__class__)[1:]:
+                            if c in self.error_handlers:
+                                exc_class = c
+                                break
+                    if exc_class:
+                        try:
+                            res = await self._invoke_handler(
+                                self.error_handlers[exc_class], req, exc)
+                        except Exception as exc2:  # pragma: no cover
+                            print_exception(exc2)
+                    if res is None:
+                        if 500 in self.error_handlers:
+                            res = await self._invoke_handler(
+                                self.error_handlers[500], req)
+                        else:
+                            res = 'Internal server error', 500
+        else:
+            if 400 in self.error_handlers:
+                res = await self._invoke_handler(self.error_handlers[400], req)
+            else:
+                res = 'Bad request', 400
+        if isinstance(res, tuple):
+            res = Response._new(*res)
+        elif not isinstance(res, BaseResponse):
+            res = Response._new(res)
+        if not after_request_handled:
+            for handler in self.after_error_request_handlers:
+                res = await self._invoke_handler(
+                    handler, req, res) or res
+        res.is_head = (req and req.method == 'HEAD')
+        return res
+
+    async def _invoke_handler(self, f_or_coro, *args, **kwargs):
+        ret = f_or_coro(*args, **kwargs)
+        if _iscoroutine(ret):
+            ret = await ret
+        return ret
+
+
+abort = Microdot.abort
+Response.already_handled = BaseResponse.already_handled
+redirect = Response.redirect
+send_file = Response.send_file
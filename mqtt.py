@@ -0,0 +1,316 @@
+import errno
+import struct
+from time import ticks_ms, ticks_diff
+from typing import Dict, List, Optional
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import uselect as select
+except ImportError:
+    import select
+
+from utils import logger
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xc0
+PINGRESP = 0xd0
+
+#: errno values of a non-blocking socket operation that would have blocked
+_WOULD_BLOCK = (errno.EAGAIN, errno.EINPROGRESS)
+
+
+def _mqtt_str(s: str) -> bytes:
+    b = s.encode()
+    return struct.pack('!H', len(b)) + b
+
+
+def _packet(header: int, body: bytes) -> bytes:
+    out = bytearray([header])
+    n = len(body)
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            break
+    return bytes(out) + body
+
+
+class MqttPublisher:
+    """
+    Publishes sensor state to an MQTT broker as retained ``ON``/``OFF``
+    messages on ``<topic_prefix>/<pin_name>/state``, over one persistent
+    MQTT 3.1.1 connection. Transitions only mark a pin as pending; publishing
+    happens from ``poll()``, which coalesces bursts so that only the latest
+    state of each pin is sent, keeps up to ``window`` QoS 1 messages in
+    flight, and reconnects with exponential backoff. Connecting, including
+    waiting for the broker's CONNACK, never blocks ``poll()``; the broker's
+    address is resolved once and kept until a connection attempt fails, as
+    ``getaddrinfo()`` is blocking.
+    """
+
+    #: Milliseconds a connection must stay up before the reconnect backoff
+    #: is reset, so that a broker that accepts and then drops connections
+    #: is not retried on every poll
+    stable_ms: int = 60000
+
+    def __init__(
+        self, sensors: List, host: str, topic_prefix: str, port: int = 1883,
+        client_id: str = '', username: Optional[str] = None,
+        password: Optional[str] = None, keepalive: int = 60, window: int = 4,
+        batch_ms: int = 0, retry_ms: int = 5000, timeout: float = 2
+    ):
+        """
+        :param sensors: Sensors whose state to publish
+        :param host: Broker hostname or IP
+        :param topic_prefix: Topic prefix, i.e. ``esp32/frontdoor``;
+          availability is published to ``<topic_prefix>/status``
+        :param port: Broker port
+        :param client_id: MQTT client ID; defaults to ``topic_prefix``
+        :param username: Optional broker username
+        :param password: Optional broker password
+        :param keepalive: MQTT keepalive in seconds
+        :param window: Maximum number of unacknowledged QoS 1 publishes
+        :param batch_ms: Milliseconds to wait after a transition for further
+          transitions before publishing, to batch bursts
+        :param retry_ms: Milliseconds after which an unacknowledged publish
+          is re-sent
+        :param timeout: Seconds after which a connection attempt that has
+          not been acknowledged by the broker fails, and socket timeout for
+          writing
+        """
+        self.sensors: List = sensors
+        self.host: str = host
+        self.port: int = port
+        self.topic_prefix: str = topic_prefix
+        self.client_id: str = client_id or topic_prefix
+        self.username: Optional[str] = username
+        self.password: Optional[str] = password
+        self.keepalive: int = keepalive
+        self.window: int = window
+        self.batch_ms: int = batch_ms
+        self.retry_ms: int = retry_ms
+        self.timeout: float = timeout
+        self.addr = None
+        self.sock = None
+        self._poller = None
+        self._rbuf: bytes = b''
+        self.connected: bool = False
+        #: Pin names whose latest state has not been published yet
+        self.pending: List[str] = [s.name for s in sensors]
+        self._pending_since: int = ticks_ms()
+        #: packet id -> [topic, payload, ticks_ms sent]
+        self.inflight: Dict[int, List] = {}
+        self._next_id: int = 1
+        self._last_io: int = ticks_ms()
+        self._backoff_ms: int = 0
+        self._last_attempt: int = ticks_ms()
+        self._connect_sent: bool = False
+        self._connected_at: int = ticks_ms()
+        self.published: int = 0
+        #: Number of failed or lost connections
+        self.reconnects: int = 0
+        self._by_name: Dict = {s.name: s for s in sensors}
+        for sensor in sensors:
+            sensor.listeners.append(self.handle_change)
+
+    def handle_change(self, sensor):
+        if sensor.name not in self.pending:
+            if not self.pending:
+                self._pending_since = ticks_ms()
+            self.pending.append(sensor.name)
+
+    def _start_connect(self):
+        logger.debug('Connecting to MQTT broker %s:%d', self.host, self.port)
+        if self.addr is None:
+            self.addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        sock = socket.socket()
+        sock.setblocking(False)
+        self.sock = sock
+        try:
+            sock.connect(self.addr)
+        except OSError as ex:
+            if ex.args[0] not in _WOULD_BLOCK:
+                raise
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLOUT)
+        self._rbuf = b''
+        self._connect_sent = False
+
+    def _advance_connect(self):
+        """
+        Send CONNECT once the TCP connection is established and read the
+        CONNACK, without blocking.
+        """
+        if ticks_diff(
+            ticks_ms(), self._last_attempt
+        ) > self.timeout * 1000:
+            raise OSError(errno.ETIMEDOUT, 'MQTT connect timed out')
+        events = self._poller.poll(0)
+        if not events:
+            return
+        ev = events[0][1]
+        if not self._connect_sent:
+            if ev & (select.POLLERR | select.POLLHUP):
+                raise OSError('MQTT connection failed')
+            if not ev & select.POLLOUT:
+                return
+            # the CONNECT packet fits in the empty send buffer, and later
+            # writes are bounded by the timeout
+            self.sock.settimeout(self.timeout)
+            self.sock.sendall(self._connect_packet())
+            self._connect_sent = True
+            self._poller.modify(self.sock, select.POLLIN)
+            return
+        data = self.sock.recv(4 - len(self._rbuf))
+        if not data:
+            raise OSError('MQTT connection closed by broker')
+        self._rbuf += data
+        if len(self._rbuf) < 4:
+            return
+        if self._rbuf[0] != CONNACK or self._rbuf[3] != 0:
+            raise OSError('MQTT connection refused: %r' % self._rbuf)
+        self._connected()
+
+    def _connect_packet(self) -> bytes:
+        flags = 0x02 | 0x04 | 0x20  # clean session, will, will retain
+        payload = _mqtt_str(self.client_id) + _mqtt_str(
+            self.topic_prefix + '/status'
+        ) + _mqtt_str('offline')
+        if self.username is not None:
+            flags |= 0x80
+            payload += _mqtt_str(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += _mqtt_str(self.password)
+        return _packet(CONNECT, _mqtt_str('MQTT') + bytes(
+            [4, flags]
+        ) + struct.pack('!H', self.keepalive) + payload)
+
+    def _connected(self):
+        self._rbuf = b''
+        self.inflight = {}
+        self.connected = True
+        self._connected_at = self._last_io = ticks_ms()
+        self._publish(self.topic_prefix + '/status', b'online')
+        # re-send every state; clean sessions lose anything in flight
+        self.pending = [s.name for s in self.sensors]
+        self._pending_since = ticks_ms() - self.batch_ms
+
+    def _lost(self, ex: Exception):
+        """Close a failed connection or attempt and back off."""
+        if not self.connected:
+            # resolve again next time, in case the broker has moved
+            self.addr = None
+        self.close()
+        self.reconnects += 1
+        self._last_attempt = ticks_ms()
+        self._backoff_ms = min(60000, max(1000, self._backoff_ms * 2))
+        logger.debug(
+            'MQTT connection failed (%s); retry in %dms', ex,
+            self._backoff_ms
+        )
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self._poller = None
+        self.connected = False
+
+    def _publish(self, topic: str, payload: bytes, packet_id: int = 0,
+                 dup: bool = False):
+        header = PUBLISH | 0x01  # retain
+        body = _mqtt_str(topic)
+        if packet_id:
+            header |= 0x02  # QoS 1
+            if dup:
+                header |= 0x08
+            body += struct.pack('!H', packet_id)
+        self.sock.sendall(_packet(header, body + payload))
+        self._last_io = ticks_ms()
+
+    def _read(self):
+        """Read and handle any packets the broker has sent."""
+        while self._poller.poll(0):
+            data = self.sock.recv(256)
+            if not data:
+                raise OSError('MQTT connection closed by broker')
+            self._rbuf += data
+        while len(self._rbuf) >= 2:
+            # decode the remaining length
+            n = 0
+            shift = 0
+            i = 1
+            while True:
+                if i >= len(self._rbuf):
+                    return
+                b = self._rbuf[i]
+                n |= (b & 0x7f) << shift
+                shift += 7
+                i += 1
+                if not b & 0x80:
+                    break
+            if len(self._rbuf) < i + n:
+                return
+            ptype = self._rbuf[0] & 0xf0
+            body = self._rbuf[i:i + n]
+            self._rbuf = self._rbuf[i + n:]
+            if ptype == PUBACK:
+                self.inflight.pop(struct.unpack('!H', body[:2])[0], None)
+
+    def poll(self):
+        """
+        Service the connection and publish pending states. Intended to be
+        registered as a microdot idle handler.
+        """
+        now = ticks_ms()
+        if not self.connected:
+            try:
+                if self.sock is None:
+                    if ticks_diff(now, self._last_attempt) < self._backoff_ms:
+                        return
+                    self._last_attempt = now
+                    self._start_connect()
+                self._advance_connect()
+            except Exception as ex:
+                self._lost(ex)
+            return
+        if self._backoff_ms and ticks_diff(
+            now, self._connected_at
+        ) >= self.stable_ms:
+            self._backoff_ms = 0
+        try:
+            self._read()
+            for packet_id, msg in self.inflight.items():
+                if ticks_diff(now, msg[2]) >= self.retry_ms:
+                    self._publish(msg[0], msg[1], packet_id, dup=True)
+                    msg[2] = now
+            if self.pending and ticks_diff(
+                now, self._pending_since
+            ) >= self.batch_ms:
+                while self.pending and len(self.inflight) < self.window:
+                    sensor = self._by_name[self.pending.pop(0)]
+                    topic = '%s/%s/state' % (self.topic_prefix, sensor.name)
+                    payload = b'ON' if sensor.input_state == 1 else b'OFF'
+                    packet_id = self._next_id
+                    self._next_id = self._next_id % 65535 + 1
+                    self.inflight[packet_id] = [topic, payload, now]
+                    self._publish(topic, payload, packet_id)
+                    self.published += 1
+            if ticks_diff(now, self._last_io) >= self.keepalive * 500:
+                self.sock.sendall(bytes([PINGREQ, 0]))
+                self._last_io = now
+        except Exception as ex:
+            self._lost(ex)
@@ -0,0 +1,182 @@
+import os
+from machine import RTC
+from time import time, ticks_ms, ticks_diff
+from typing import List, Dict, Optional
+
+from utils import logger
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+class StatePersister:
+    """
+    Persists sensor state and timing, and the event sequence number, across
+    reboots. State is written to RTC memory (which survives
+    ``machine.reset()`` but not power loss) on every change, and snapshotted
+    to flash at most once every ``flash_interval`` seconds as a fallback, to
+    avoid wearing out the flash.
+    """
+
+    #: Path of the flash snapshot
+    flash_path: str = 'state.json'
+
+    #: Bytes of RTC user memory (2048 on ESP32); state that does not fit is
+    #: only snapshotted to flash
+    rtc_size: int = 2048
+
+    def __init__(self, sensors: List, events, flash_interval: int = 300):
+        """
+        :param sensors: List of Sensors to persist
+        :param events: The device's EventRing
+        :param flash_interval: Minimum seconds between flash writes
+        """
+        self.sensors: List = sensors
+        self.events = events
+        self.flash_interval: int = flash_interval
+        self.rtc: RTC = RTC()
+        #: Where the saved state was loaded from: ``rtc``, ``flash`` or
+        #: ``none``
+        self.source: str = 'none'
+        #: Number of sensors whose saved state was restored
+        self.restored: int = 0
+        self.flash_writes: int = 0
+        #: Whether the last state fitted into RTC memory
+        self.rtc_fits: bool = True
+        self._saved: Optional[Dict] = self._load()
+        if self._saved:
+            # before any transition is recorded or served, so that client
+            # cursors stay valid; the timestamps wait for restore()
+            events.restore_seq(self._saved.get('seq', 0))
+        self._changed: List[str] = []
+        self._dirty: bool = False
+        self._last_flash_ticks: int = ticks_ms()
+        for sensor in sensors:
+            sensor.listeners.append(self.handle_change)
+
+    def _load(self) -> Optional[Dict]:
+        try:
+            data = json.loads(self.rtc.memory())
+            if isinstance(data, dict) and 'sensors' in data:
+                self.source = 'rtc'
+                return data
+        except Exception as ex:
+            logger.debug('No saved state in RTC memory: %s', ex)
+        try:
+            with open(self.flash_path, 'r') as fh:
+                data = json.loads(fh.read())
+            self.source = 'flash'
+            return data
+        except Exception as ex:
+            logger.debug('No saved state in flash: %s', ex)
+        return None
+
+    def restore(self):
+        """
+        Apply the saved state to sensors that have not changed since boot and
+        are still in the saved state. Call once the clock is set, as saved
+        timestamps from the future are ignored.
+        """
+        if not self._saved:
+            return
+        saved = self._saved
+        self._saved = None
+        now = time()
+        for sensor in self.sensors:
+            if sensor.name in self._changed:
+                continue
+            s = saved['sensors'].get(sensor.name)
+            if not s or s[0] != sensor.input_state:
+                continue
+            state, on_time, off_time, glitches = s
+            if on_time > now or off_time > now:
+                logger.debug(
+                    'Saved state for %s is from the future; clock not set?',
+                    sensor.name
+                )
+                continue
+            sensor._input_on_time = on_time
+            sensor._input_off_time = off_time
+            sensor.glitch_count = glitches
+            self.restored += 1
+        logger.info(
+            'Restored state of %d sensors from %s', self.restored, self.source
+        )
+        self.save_rtc()
+
+    def _serialize(self) -> str:
+        return json.dumps({
+            'seq': self.events.next_seq,
+            'sensors': {
+                s.name: [
+                    s.input_state, s._input_on_time, s._input_off_time,
+                    s.glitch_count
+                ] for s in self.sensors
+            }
+        })
+
+    def save_rtc(self):
+        self._write_rtc(self._serialize().encode())
+
+    def _write_rtc(self, data: bytes):
+        fits = len(data) <= self.rtc_size
+        if fits != self.rtc_fits:
+            self.rtc_fits = fits
+            if not fits:
+                logger.info(
+                    'State (%d bytes) does not fit into RTC memory; only '
+                    'saving it to flash', len(data)
+                )
+        try:
+            # clear what was saved before rather than leave it to be
+            # restored when the state doesn't fit
+            self.rtc.memory(data if fits else b'')
+        except Exception as ex:
+            logger.debug('Could not save state to RTC memory: %s', ex)
+
+    def save(self):
+        """
+        Save the current state to RTC memory right away, and to flash with
+        the next snapshot; i.e. after the clock was stepped, as state saved
+        before holds timestamps from before the step.
+        """
+        self._dirty = True
+        self.save_rtc()
+
+    def handle_change(self, sensor):
+        if self._saved is not None:
+            # restore() is still pending; don't overwrite the saved state,
+            # in case we reboot again before then, but do keep the sequence
+            # number of the recorded event
+            self._dirty = True
+            if sensor.name not in self._changed:
+                self._changed.append(sensor.name)
+            self._saved['seq'] = self.events.next_seq
+        # runs in the pin IRQ, so nothing may escape
+        try:
+            if self._saved is not None:
+                self._write_rtc(json.dumps(self._saved).encode())
+            else:
+                self.save()
+        except Exception as ex:
+            logger.debug('Could not save state: %s', ex)
+
+    def poll(self):
+        """
+        Write the flash snapshot if anything changed and the last write was
+        at least ``flash_interval`` seconds ago. Intended to be registered as
+        a microdot idle handler.
+        """
+        if self._saved is not None or not self._dirty or ticks_diff(
+            ticks_ms(), self._last_flash_ticks
+        ) < self.flash_interval * 1000:
+            return
+        tmp = self.flash_path + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(self._serialize())
+        os.rename(tmp, self.flash_path)
+        self._dirty = False
+        self._last_flash_ticks = ticks_ms()
+        self.flash_writes += 1
@@ -1,16 +1,245 @@
 import sys
 from machine import Pin
-from typing import List, Optional
-from time import time
+from typing import List, Optional, Dict, Tuple
+from time import time, ticks_ms, ticks_diff
 
 from utils import logger
+from events import EventRing
 
 
-class GpioSensor:
+class Sensor:
+
+    #: GPIO pin number to use for the ``pin_number`` label; -1 for sensors
+    #: that are not backed by a single physical pin.
+    pin_num: int = -1
+
+    #: URL to POST a JSON notification to on every transition, if any; set
+    #: from the ``webhook`` key of the sensor's entry in ``DEVICE_CONFIG``.
+    webhook: Optional[str] = None
+
+    #: Metrics exposed for every sensor of this type, as 4-tuples of metric
+    #: name, help string, attribute name and metric type. Sensor types that
+    #: expose additional metrics extend this tuple.
+    metrics: Tuple = (
+        (
+            'gpio_pin_is_on', 'Whether the GPIO pin is on (1) or off (2)',
+            'input_state', 'gauge'
+        ),
+        (
+            'gpio_pin_on_seconds',
+            'How many seconds the pin has been on; -1 if it is off.',
+            'input_on_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_off_seconds',
+            'How many seconds the pin has been off; -1 if it is on.',
+            'input_off_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_seconds_since_on',
+            'How many seconds since the pin last turned on.',
+            'seconds_since_on', 'gauge'
+        ),
+        (
+            'gpio_pin_seconds_since_off',
+            'How many seconds since the pin last turned off.',
+            'seconds_since_off', 'gauge'
+        ),
+        (
+            'gpio_pin_min_on_pulse_seconds',
+            'Shortest on pulse in the current window; -1 if none yet.',
+            'min_on_pulse_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_max_on_pulse_seconds',
+            'Longest on pulse in the current window; -1 if none yet.',
+            'max_on_pulse_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_min_off_pulse_seconds',
+            'Shortest off pulse in the current window; -1 if none yet.',
+            'min_off_pulse_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_max_off_pulse_seconds',
+            'Longest off pulse in the current window; -1 if none yet.',
+            'max_off_pulse_seconds', 'gauge'
+        ),
+        (
+            'gpio_pin_glitches',
+            'Number of pulses shorter than glitch_ms in the current window.',
+            'glitches', 'gauge'
+        ),
+    )
+
+    def __init__(self, name: str, glitch_ms: int = 0, pulse_window: int = 0):
+        """
+        Base class for anything with an on/off state whose state and timing
+        we want to expose to Prometheus.
+
+        :param name: Friendly name of the sensor, to use as a prometheus label
+        :param glitch_ms: Pulses shorter than this many milliseconds are
+          counted as glitches instead of updating the min/max pulse widths
+        :param pulse_window: If non-zero, reset the pulse width and glitch
+          statistics every this many seconds
+        """
+        self.name: str = name
+        self.glitch_ms: int = glitch_ms
+        self.pulse_window: int = pulse_window
+        #: Callables taking this sensor as their only argument, called after
+        #: every committed state transition.
+        self.listeners: List = []
+        self._input_state: int = -1
+        self._input_on_time: float = -1
+        self._input_off_time: float = -1
+        self._last_change_ticks: int = ticks_ms()
+        self.reset_pulse_stats()
+
+    def labels(self) -> Dict:
+        """
+        Return a new dict of the prometheus labels identifying this sensor.
+        """
+        return {'pin_name': self.name, 'pin_number': self.pin_num}
+
+    @property
+    def input_on_seconds(self) -> float:
+        if self._input_state == 1:
+            return self.seconds_since_on
+        return -1
+
+    @property
+    def input_off_seconds(self) -> float:
+        if self._input_state == 0:
+            return self.seconds_since_off
+        return -1
+
+    @property
+    def input_state(self) -> int:
+        return self._input_state
+
+    @property
+    def seconds_since_on(self) -> float:
+        if self._input_on_time == -1:
+            return -1
+        return time() - self._input_on_time
+
+    @property
+    def seconds_since_off(self) -> float:
+        if self._input_off_time == -1:
+            return -1
+        return time() - self._input_off_time
+
+    @property
+    def min_on_pulse_seconds(self) -> float:
+        self._check_pulse_window()
+        return self._ms_to_seconds(self.min_on_ms)
+
+    @property
+    def max_on_pulse_seconds(self) -> float:
+        self._check_pulse_window()
+        return self._ms_to_seconds(self.max_on_ms)
+
+    @property
+    def min_off_pulse_seconds(self) -> float:
+        self._check_pulse_window()
+        return self._ms_to_seconds(self.min_off_ms)
+
+    @property
+    def max_off_pulse_seconds(self) -> float:
+        self._check_pulse_window()
+        return self._ms_to_seconds(self.max_off_ms)
+
+    @property
+    def glitches(self) -> int:
+        self._check_pulse_window()
+        return self.glitch_count
+
+    @staticmethod
+    def _ms_to_seconds(ms: int) -> float:
+        if ms == -1:
+            return -1
+        return ms / 1000
+
+    def reset_pulse_stats(self):
+        """
+        Reset the min/max pulse widths and the glitch counter, and start a new
+        statistics window.
+        """
+        self.min_on_ms: int = -1
+        self.max_on_ms: int = -1
+        self.min_off_ms: int = -1
+        self.max_off_ms: int = -1
+        self.glitch_count: int = 0
+        self._pulse_window_start: float = time()
+
+    def adjust_time(self, step: int):
+        """
+        Shift the wall-clock timestamps of this sensor by ``step`` seconds,
+        i.e. when the clock is first set after boot, so that transitions
+        recorded before then keep their true age.
+        """
+        if self._input_on_time != -1:
+            self._input_on_time += step
+        if self._input_off_time != -1:
+            self._input_off_time += step
+        self._pulse_window_start += step
+
+    def _check_pulse_window(self):
+        if (
+            self.pulse_window and
+            time() - self._pulse_window_start >= self.pulse_window
+        ):
+            self.reset_pulse_stats()
+
+    def _record_pulse(self, was_on: bool):
+        """
+        Update the pulse width statistics for the pulse that just ended. This
+        is O(1) and allocation-free so that it is safe to call from the IRQ
+        handler.
+        """
+        now = ticks_ms()
+        width = ticks_diff(now, self._last_change_ticks)
+        self._last_change_ticks = now
+        self._check_pulse_window()
+        if width < self.glitch_ms:
+            self.glitch_count += 1
+            return
+        if was_on:
+            if self.min_on_ms == -1 or width < self.min_on_ms:
+                self.min_on_ms = width
+            if width > self.max_on_ms:
+                self.max_on_ms = width
+        else:
+            if self.min_off_ms == -1 or width < self.min_off_ms:
+                self.min_off_ms = width
+            if width > self.max_off_ms:
+                self.max_off_ms = width
+
+    def set_input_on(self, source=None):
+        logger.debug('%s is ON', source or self.name)
+        if self._input_state == 0:
+            self._record_pulse(False)
+        self._input_state = 1
+        self._input_on_time = time()
+        for listener in self.listeners:
+            listener(self)
+
+    def set_input_off(self, source=None):
+        logger.debug('%s is OFF', source or self.name)
+        if self._input_state == 1:
+            self._record_pulse(True)
+        self._input_state = 0
+        self._input_off_time = time()
+        for listener in self.listeners:
+            listener(self)
+
+
+class GpioSensor(Sensor):
 
     def __init__(
         self, name: str, pin_num: int, pull_up: bool = False,
-        pull_down: bool = False, on_value: int = 1
+        pull_down: bool = False, on_value: int = 1, glitch_ms: int = 0,
+        pulse_window: int = 0
     ):
         """
         Defines a single GPIO pin that we want to monitor.
@@ -22,10 +251,14 @@ class GpioSensor:
         :param pull_down: Whether to enable the internal pull-down resistor;
           mutually exclusive with ``pull_up``
         :param on_value: The value (1 or 0) when the pin is in an "on" state
+        :param glitch_ms: Pulses shorter than this many milliseconds are
+          counted as glitches instead of updating the min/max pulse widths
+        :param pulse_window: If non-zero, reset the pulse width and glitch
+          statistics every this many seconds
         """
         assert not (pull_down and pull_up), \
             "pull_up and pull_down are mutually exclusive"
-        self.name: str = name
+        super().__init__(name, glitch_ms=glitch_ms, pulse_window=pulse_window)
         self.pin_num: int = pin_num
         self.pull_up: bool = pull_up
         self.pull_down: bool = pull_down
@@ -35,9 +268,6 @@ class GpioSensor:
             'on_value=%d)', self.name, self.pin_num, self.pull_up,
             self.pull_down, self.on_value
         )
-        self._input_state: int = -1
-        self._input_on_time: float = -1
-        self._input_off_time: float = -1
         pull = None
         if self.pull_up:
             pull = Pin.PULL_UP
@@ -54,61 +284,273 @@ class GpioSensor:
         else:
             self.set_input_off(self.pin)
 
-    @property
-    def input_on_seconds(self) -> float:
-        if self._input_state == 1:
-            return self.seconds_since_on
-        return -1
+    def handle_change(self, pin: Pin):
+        state = 1 if pin.value() == self.on_value else 0
+        if state == self._input_state:
+            # the pin changed and changed back before we could read it; this
+            # pulse was too short to measure, so it can only be a glitch
+            self._check_pulse_window()
+            self.glitch_count += 1
+            return
+        if state == 1:
+            self.set_input_on(pin)
+        else:
+            self.set_input_off(pin)
 
-    @property
-    def input_off_seconds(self) -> float:
-        if self._input_state == 0:
-            return self.seconds_since_off
-        return -1
 
-    @property
-    def input_state(self) -> int:
-        return self._input_state
+class CompositeSensor(Sensor):
 
-    @property
-    def seconds_since_on(self) -> float:
-        if self._input_on_time == -1:
-            return -1
-        return time() - self._input_on_time
+    #: Operator precedence for the expression compiler
+    _PRECEDENCE: Dict[str, int] = {'or': 1, 'and': 2, 'not': 3}
 
-    @property
-    def seconds_since_off(self) -> float:
-        if self._input_off_time == -1:
-            return -1
-        return time() - self._input_off_time
+    def __init__(
+        self, name: str, expr: str, sensors: Dict[str, Sensor],
+        glitch_ms: int = 0, pulse_window: int = 0
+    ):
+        """
+        Defines a derived on/off state computed from a boolean expression over
+        other sensors, i.e. ``latch and leftmag and rightmag``. The expression
+        is compiled once, and re-evaluated only when one of its inputs
+        transitions.
 
-    def set_input_on(self, pin: Pin):
-        logger.debug('Pin %s is ON', pin)
-        self._input_state = 1
-        self._input_on_time = time()
+        :param name: Friendly name of the composite, to use as a prometheus
+          label
+        :param expr: Boolean expression over sensor names, using ``and``,
+          ``or``, ``not`` and parentheses. A sensor name is true when that
+          sensor is on.
+        :param sensors: Dict of sensor name to Sensor, for the sensors that
+          the expression may refer to
+        :param glitch_ms: Pulses shorter than this many milliseconds are
+          counted as glitches instead of updating the min/max pulse widths
+        :param pulse_window: If non-zero, reset the pulse width and glitch
+          statistics every this many seconds
+        """
+        super().__init__(name, glitch_ms=glitch_ms, pulse_window=pulse_window)
+        self.expr: str = expr
+        logger.info(
+            'Instantiating CompositeSensor "%s" = %s', self.name, self.expr
+        )
+        self._program: List = self._compile(expr, sensors)
+        self.inputs: List[Sensor] = []
+        for item in self._program:
+            if isinstance(item, Sensor) and item not in self.inputs:
+                self.inputs.append(item)
+                item.listeners.append(self.handle_change)
+        if self.evaluate():
+            self.set_input_on()
+        else:
+            self.set_input_off()
 
-    def set_input_off(self, pin: Pin):
-        logger.debug('Pin %s is OFF', pin)
-        self._input_state = 0
-        self._input_off_time = time()
+    @classmethod
+    def _compile(cls, expr: str, sensors: Dict[str, Sensor]) -> List:
+        """
+        Compile a boolean expression to a list in reverse polish notation,
+        where each item is either a Sensor or an operator string.
+        """
+        output: List = []
+        ops: List[str] = []
+        for token in expr.replace('(', ' ( ').replace(')', ' ) ').split():
+            if token == '(':
+                ops.append(token)
+            elif token == ')':
+                while ops and ops[-1] != '(':
+                    output.append(ops.pop())
+                if not ops:
+                    raise ValueError('Unbalanced parentheses in: ' + expr)
+                ops.pop()
+            elif token in cls._PRECEDENCE:
+                # "not" is a right-associative unary operator
+                while (
+                    token != 'not' and ops and ops[-1] != '(' and
+                    cls._PRECEDENCE[ops[-1]] >= cls._PRECEDENCE[token]
+                ):
+                    output.append(ops.pop())
+                ops.append(token)
+            elif token in sensors:
+                output.append(sensors[token])
+            else:
+                raise ValueError(
+                    'Unknown sensor "%s" in: %s' % (token, expr)
+                )
+        while ops:
+            op = ops.pop()
+            if op == '(':
+                raise ValueError('Unbalanced parentheses in: ' + expr)
+            output.append(op)
+        return output
 
-    def handle_change(self, pin: Pin):
-        if pin.value() == self.on_value:
-            self.set_input_on(pin)
+    def evaluate(self) -> bool:
+        stack: List[bool] = []
+        for item in self._program:
+            if item == 'not':
+                stack.append(not stack.pop())
+            elif item == 'and':
+                b = stack.pop()
+                stack.append(stack.pop() and b)
+            elif item == 'or':
+                b = stack.pop()
+                stack.append(stack.pop() or b)
+            else:
+                stack.append(item.input_state == 1)
+        if len(stack) != 1:
+            raise ValueError('Invalid expression: ' + self.expr)
+        return stack[0]
+
+    def handle_change(self, _: Sensor):
+        state = 1 if self.evaluate() else 0
+        if state == self._input_state:
+            return
+        if state == 1:
+            self.set_input_on()
         else:
-            self.set_input_off(pin)
+            self.set_input_off()
+
+
+#: Sensor type name (the ``type`` key of a ``pins`` entry in
+#: ``DEVICE_CONFIG``) to 2-tuple of module name and class name. Modules are
+#: imported only when a board actually configures a sensor of that type.
+SENSOR_TYPES: Dict[str, Tuple[str, str]] = {
+    'gpio': ('promdevice', 'GpioSensor'),
+    'touch': ('touchsensor', 'TouchSensor'),
+}
+
+
+def register_sensor_type(type_name: str, module: str, class_name: str):
+    """
+    Register a sensor type so that it can be used in ``DEVICE_CONFIG``.
+
+    :param type_name: Value of the ``type`` key in pin configuration dicts
+    :param module: Name of the module defining the sensor class
+    :param class_name: Name of the ``Sensor`` subclass in that module
+    """
+    SENSOR_TYPES[type_name] = (module, class_name)
+
+
+def create_sensor(conf: Dict) -> Sensor:
+    """
+    Instantiate a sensor from a ``pins`` entry in ``DEVICE_CONFIG``, importing
+    the module for its type on first use.
+
+    :param conf: Keyword arguments for the sensor class, plus an optional
+      ``type`` key naming the sensor type (default ``gpio``) and an optional
+      ``webhook`` URL
+    """
+    conf = dict(conf)
+    type_name = conf.pop('type', 'gpio')
+    webhook = conf.pop('webhook', None)
+    if type_name not in SENSOR_TYPES:
+        raise ValueError('Unknown sensor type: %s' % type_name)
+    module_name, class_name = SENSOR_TYPES[type_name]
+    module = sys.modules.get(module_name)
+    if module is None:
+        logger.debug('Importing %s for sensor type %s', module_name, type_name)
+        module = __import__(module_name)
+    sensor = getattr(module, class_name)(**conf)
+    sensor.webhook = webhook
+    return sensor
 
 
 class PrometheusDevice:
 
     def __init__(
-        self, name: str, pins: List[GpioSensor], hostname: Optional[str] = None
+        self, name: str, pins: List[Sensor], hostname: Optional[str] = None,
+        composites: Optional[List[Dict]] = None, event_capacity: int = 128,
+        history_bytes: int = 0, history_retention: int = 86400,
+        history_interval: int = 300, persist_state: bool = True,
+        persist_flash_interval: int = 300, push: Optional[Dict] = None,
+        mqtt: Optional[Dict] = None, webhook_queue: int = 8,
+        statsd: Optional[Dict] = None, server_mode: str = 'sync',
+        priority_addresses: Optional[List[str]] = None,
+        tls: Optional[Dict] = None, http_stats: bool = True,
+        wlan_reuse_ip: bool = False
     ):
+        """
+        :param name: Name of the device
+        :param pins: List of physical sensors (GpioSensor, TouchSensor) on the
+          device
+        :param hostname: DHCP hostname; defaults to ``name``
+        :param composites: List of dicts matching the keyword arguments of
+          ``CompositeSensor`` (except ``sensors``). Expressions may refer to
+          pins and to composites defined earlier in the list.
+        :param event_capacity: Number of transitions retained in the event
+          ring buffer served at ``/events``
+        :param history_bytes: Memory budget, in bytes, for the history buffer
+          served at ``/history``; 0 to disable it
+        :param history_retention: Maximum age, in seconds, of history records
+        :param history_interval: Seconds between history snapshot records
+        :param persist_state: Whether to persist sensor state and timing
+          across reboots
+        :param persist_flash_interval: Minimum seconds between writes of the
+          persisted state to flash
+        :param push: If set, push metrics to a Pushgateway or remote_write
+          receiver; a dict of keyword arguments for the ``Pusher`` class in
+          ``push.py`` (other than ``collect`` and ``sensors``)
+        :param mqtt: If set, publish sensor state to an MQTT broker; a dict of
+          keyword arguments for the ``MqttPublisher`` class in ``mqtt.py``
+          (other than ``sensors``)
+        :param webhook_queue: Maximum number of sensors with a webhook
+          notification waiting to be sent
+        :param statsd: If set, send metrics as StatsD UDP datagrams; a dict of
+          keyword arguments for the ``StatsdEmitter`` class in ``statsd.py``
+          (other than ``collect`` and ``sensors``)
+        :param server_mode: ``sync`` to serve one connection at a time from
+          the ``microdot`` accept loop, or ``async`` to serve connections as
+          ``uasyncio`` tasks with ``microdot_asyncio``
+        :param priority_addresses: IP addresses of clients (i.e. the
+          Prometheus servers) that are served even when the server is
+          saturated; only with the ``async`` server mode, as the ``sync``
+          mode serves one connection at a time and is never saturated
+        :param tls: If set, serve HTTPS instead of HTTP; a dict with ``cert``
+          and ``key`` (paths to the certificate and private key files on the
+          board) and optionally ``port`` (default 443)
+        :param http_stats: Whether to expose request counts, byte counts and
+          latency histograms of the HTTP server
+        :param wlan_reuse_ip: Whether to reuse the IP configuration from the
+          last DHCP lease when reconnecting to the same access point, instead
+          of waiting for DHCP; only safe with a DHCP reservation for the board
+        """
+        assert server_mode in ('sync', 'async'), \
+            "server_mode must be sync or async"
         self.name: str = name
-        self.pins: List[GpioSensor] = pins
+        self.pins: List[Sensor] = pins
         if hostname:
             self.hostname: str = hostname
         else:
             self.hostname: str = name
         assert len(self.hostname) < 16,\
             "Hostname must be less than 16 characters"
+        by_name: Dict[str, Sensor] = {x.name: x for x in pins}
+        self.composites: List[CompositeSensor] = []
+        for conf in (composites or []):
+            conf = dict(conf)
+            webhook = conf.pop('webhook', None)
+            c = CompositeSensor(**conf, sensors=by_name)
+            c.webhook = webhook
+            by_name[c.name] = c
+            self.composites.append(c)
+        #: All sensors, physical and derived, in exposition order
+        self.sensors: List[Sensor] = self.pins + self.composites
+        self.events: EventRing = EventRing(self.sensors, event_capacity)
+        self.history = None
+        if history_bytes:
+            from history import HistoryBuffer
+            self.history: HistoryBuffer = HistoryBuffer(
+                self.sensors, size=history_bytes,
+                retention=history_retention, interval=history_interval
+            )
+        self.push: Optional[Dict] = push
+        self.mqtt: Optional[Dict] = mqtt
+        self.webhook_queue: int = webhook_queue
+        self.statsd: Optional[Dict] = statsd
+        self.server_mode: str = server_mode
+        self.priority_addresses: List[str] = priority_addresses or []
+        self.tls: Optional[Dict] = tls
+        self.http_stats: bool = http_stats
+        self.wlan_reuse_ip: bool = wlan_reuse_ip
+        self.persister = None
+        if persist_state:
+            from persist import StatePersister
+            self.persister: StatePersister = StatePersister(
+                self.sensors, self.events,
+                flash_interval=persist_flash_interval
+            )
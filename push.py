@@ -0,0 +1,262 @@
+import struct
+from time import ticks_ms, ticks_diff
+from typing import Callable, Dict, List, Tuple
+
+from httpclient import HttpClient
+from utils import logger, prom_metric_str, unix_time_ms
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _pb_bytes(field: int, data: bytes) -> bytes:
+    """Encode a length-delimited protobuf field."""
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def snappy_literal(data: bytes) -> bytes:
+    """
+    Return ``data`` in the snappy block format, as literal elements only. This
+    is a valid snappy stream that any decoder accepts; it saves the code size
+    and CPU of a real compressor at the cost of no compression.
+    """
+    out = bytearray(_varint(len(data)))
+    mv = memoryview(data)
+    for start in range(0, len(data), 65536):
+        chunk = mv[start:start + 65536]
+        n = len(chunk) - 1
+        if n < 60:
+            out.append(n << 2)
+        elif n < 256:
+            out.append(60 << 2)
+            out.append(n)
+        else:
+            out.append(61 << 2)
+            out.extend(struct.pack('<H', n))
+        out.extend(chunk)
+    return bytes(out)
+
+
+class Pusher:
+    """
+    Pushes metrics to a Prometheus Pushgateway, or to a Prometheus
+    remote_write receiver, for boards that Prometheus cannot scrape. Pushes
+    happen every ``interval`` seconds and, optionally, soon after a sensor
+    transition. Remote write samples that could not be sent are kept in a
+    bounded backlog and sent in one batch once the receiver is reachable
+    again.
+    """
+
+    def __init__(
+        self, collect: Callable, sensors: List, url: str,
+        mode: str = 'pushgateway', job: str = 'esp32', instance: str = '',
+        interval: int = 60, on_transition: bool = True,
+        min_interval: int = 1, max_backlog: int = 10, max_retries: int = 5,
+        timeout: float = 2
+    ):
+        """
+        :param collect: Callable returning metric families as 4-tuples of the
+          positional arguments to ``prom_metric_str``
+        :param sensors: Sensors whose transitions trigger a push
+        :param url: Base URL of the Pushgateway, or full URL of the
+          remote_write endpoint (i.e. ``http://prom:9090/api/v1/write``)
+        :param mode: ``pushgateway`` or ``remote_write``
+        :param job: Pushgateway job name, or ``job`` label for remote write
+        :param instance: ``instance`` grouping key / label
+        :param interval: Seconds between scheduled pushes
+        :param on_transition: Whether to also push soon after transitions
+        :param min_interval: Minimum seconds between pushes, so that a burst
+          of transitions results in one push
+        :param max_backlog: Maximum number of unsent remote write snapshots to
+          keep; the oldest is dropped when full
+        :param max_retries: Consecutive failures after which the oldest
+          unsent snapshot is dropped
+        :param timeout: Socket timeout in seconds
+        """
+        assert mode in ('pushgateway', 'remote_write'), \
+            "mode must be pushgateway or remote_write"
+        self.collect: Callable = collect
+        self.mode: str = mode
+        self.job: str = job
+        self.instance: str = instance
+        self.interval_ms: int = interval * 1000
+        self.min_interval_ms: int = min_interval * 1000
+        self.max_backlog: int = max_backlog
+        self.max_retries: int = max_retries
+        self.client: HttpClient = HttpClient(url, timeout=timeout)
+        self.path: str = ''
+        if mode == 'pushgateway':
+            self.path = '/metrics/job/' + job
+            if instance:
+                self.path += '/instance/' + instance
+        #: Unsent snapshots, oldest first, as (unix_ms, families) tuples
+        self.backlog: List[Tuple[int, List]] = []
+        #: Snapshots in the request in flight
+        self._sending: List[Tuple[int, List]] = []
+        self.pushes: int = 0
+        self.failures: int = 0
+        self.dropped: int = 0
+        self._retries: int = 0
+        self._backoff_ms: int = 0
+        self._pending: bool = False
+        self._last_attempt: int = ticks_ms()
+        self._last_collect: int = ticks_ms() - self.interval_ms
+        if on_transition:
+            for sensor in sensors:
+                sensor.listeners.append(self.handle_change)
+
+    def handle_change(self, _):
+        self._pending = True
+
+    def adjust_time(self, step_ms: int):
+        """
+        Shift the timestamps of unsent snapshots by ``step_ms`` milliseconds,
+        i.e. when the clock is first set after boot, as a remote_write
+        receiver rejects samples from before the clock was set.
+        """
+        shifted = {id(s): (s[0] + step_ms, s[1]) for s in self.backlog}
+        self.backlog = [shifted[id(s)] for s in self.backlog]
+        # keep the request in flight matching the backlog, so that its
+        # snapshots are still removed once it succeeds
+        self._sending = [shifted.get(id(s), s) for s in self._sending]
+
+    def poll(self):
+        """
+        Collect and push if due. Intended to be registered as a microdot idle
+        handler.
+        """
+        now = ticks_ms()
+        since = ticks_diff(now, self._last_collect)
+        if since >= self.interval_ms or (
+            self._pending and since >= self.min_interval_ms
+        ):
+            self._pending = False
+            self._last_collect = now
+            self._enqueue((unix_time_ms(), self.collect()))
+        if self.client.busy:
+            try:
+                resp = self.client.poll()
+                if resp is not None:
+                    self._done(*resp)
+            except Exception as ex:
+                self._failed(ex)
+        elif self.backlog and ticks_diff(
+            now, self._last_attempt
+        ) >= self._backoff_ms:
+            self._last_attempt = now
+            self.flush()
+
+    def _enqueue(self, snapshot: Tuple[int, List]):
+        if self.mode == 'pushgateway':
+            # the Pushgateway only keeps the latest values anyway
+            self.backlog = [snapshot]
+            return
+        if len(self.backlog) >= self.max_backlog:
+            self.backlog.pop(0)
+            self.dropped += 1
+        self.backlog.append(snapshot)
+
+    def flush(self):
+        """
+        Start sending everything in the backlog; the response is handled by
+        ``poll()``, so this does not wait for the receiver.
+        """
+        self._sending = list(self.backlog)
+        try:
+            if self.mode == 'pushgateway':
+                self.client.start(
+                    'PUT', self.path, self.encode_text(self.backlog[-1][1]),
+                    {'Content-Type': 'text/plain; version=0.0.4'}
+                )
+            else:
+                self.client.start(
+                    'POST', self.path,
+                    snappy_literal(self.encode_remote_write(self.backlog)), {
+                        'Content-Type': 'application/x-protobuf',
+                        'Content-Encoding': 'snappy',
+                        'X-Prometheus-Remote-Write-Version': '0.1.0'
+                    }
+                )
+        except Exception as ex:
+            self._failed(ex)
+
+    def _done(self, status: int, body: bytes):
+        if status >= 300:
+            self._failed(OSError('HTTP %d: %s' % (status, body[:100])))
+            return
+        self.pushes += 1
+        # keep anything collected while the request was in flight
+        self.backlog = [
+            s for s in self.backlog
+            if not [x for x in self._sending if x is s]
+        ]
+        self._sending = []
+        self._retries = 0
+        self._backoff_ms = 0
+
+    def _failed(self, ex: Exception):
+        self._sending = []
+        self.failures += 1
+        self._retries += 1
+        self._backoff_ms = min(
+            self.interval_ms, 1000 * 2 ** min(self._retries, 10)
+        )
+        logger.debug('Push failed (%s); retry in %dms', ex, self._backoff_ms)
+        if self._retries >= self.max_retries and self.backlog:
+            self.backlog.pop(0)
+            self.dropped += 1
+            self._retries = 0
+
+    @staticmethod
+    def encode_text(families: List) -> bytes:
+        return ''.join(
+            [prom_metric_str(*family) for family in families]
+        ).encode()
+
+    def encode_remote_write(self, snapshots: List[Tuple[int, List]]) -> bytes:
+        """
+        Encode snapshots as a remote_write ``WriteRequest`` protobuf, with
+        one ``TimeSeries`` per label set holding a sample per snapshot.
+        """
+        series: Dict[Tuple, bytearray] = {}
+        order: List[Tuple] = []
+        for ts, families in snapshots:
+            ts_enc = _varint(ts)
+            for name, _, values, _ in families:
+                for labels, value in values:
+                    key = (labels.get('__name__', name),) + tuple(sorted(
+                        [(k, str(v)) for k, v in labels.items()
+                         if k != '__name__']
+                    ))
+                    if key not in series:
+                        series[key] = bytearray()
+                        order.append(key)
+                    # Sample: double value = 1; int64 timestamp = 2;
+                    series[key].extend(_pb_bytes(
+                        2, b'\x09' + struct.pack('<d', value) + b'\x10' +
+                        ts_enc
+                    ))
+        out = bytearray()
+        for key in order:
+            labels = [('__name__', key[0]), ('job', self.job)] + \
+                list(key[1:])
+            if self.instance:
+                labels.append(('instance', self.instance))
+            ts_data = bytearray()
+            for k, v in sorted(labels):
+                # Label: string name = 1; string value = 2;
+                ts_data.extend(_pb_bytes(
+                    1, _pb_bytes(1, k.encode()) + _pb_bytes(2, v.encode())
+                ))
+            ts_data.extend(series[key])
+            out.extend(_pb_bytes(1, ts_data))
+        return bytes(out)
@@ -0,0 +1,143 @@
+from array import array
+from time import ticks_ms, ticks_diff
+from typing import Callable, Dict, List, Optional
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+from utils import logger
+
+
+class StatsdEmitter:
+    """
+    Sends metrics as StatsD (or DogStatsD, with labels as tags) UDP
+    datagrams: a ``gpio_pin_transitions`` counter and ``gpio_pin_is_on``
+    gauge soon after any transition, and every metric family as gauges every
+    ``interval`` seconds. Lines are packed into one preallocated buffer and
+    sent whenever the next line would not fit in a ``mtu``-sized datagram, so
+    there is no per-metric allocation of packets and no connection state.
+    """
+
+    def __init__(
+        self, collect: Callable, sensors: List, host: str, port: int = 8125,
+        prefix: str = 'esp32', interval: int = 10, dogstatsd: bool = True,
+        tags: Optional[Dict[str, str]] = None, mtu: int = 1400
+    ):
+        """
+        :param collect: Callable returning metric families as 4-tuples of the
+          positional arguments to ``prom_metric_str``
+        :param sensors: Sensors whose transitions to send
+        :param host: StatsD server hostname or IP
+        :param port: StatsD server UDP port
+        :param prefix: Prefix for metric names, separated by a ``.``
+        :param interval: Seconds between sending all metric families
+        :param dogstatsd: Whether to send labels as DogStatsD tags; if False,
+          label values are appended to the metric name instead
+        :param tags: Extra tags / labels for every metric
+        :param mtu: Maximum datagram payload size in bytes
+        """
+        self.collect: Callable = collect
+        self.sensors: List = sensors
+        self.host: str = host
+        self.port: int = port
+        self.prefix: str = prefix + '.' if prefix else ''
+        self.interval_ms: int = interval * 1000
+        self.dogstatsd: bool = dogstatsd
+        self.tags: Dict[str, str] = tags or {}
+        self.buf: bytearray = bytearray(mtu)
+        self._mv: memoryview = memoryview(self.buf)
+        self._len: int = 0
+        self.addr = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.packets: int = 0
+        self.errors: int = 0
+        #: Transitions per sensor not sent yet
+        self._transitions: array = array('H', (0 for _ in sensors))
+        self._pending: bool = False
+        self._last_send: int = ticks_ms() - self.interval_ms
+        for idx, sensor in enumerate(sensors):
+            sensor.listeners.append(
+                lambda s, idx=idx: self.handle_change(idx)
+            )
+
+    def handle_change(self, idx: int):
+        if self._transitions[idx] < 65535:
+            self._transitions[idx] += 1
+        self._pending = True
+
+    def _line(self, name: str, labels: Dict, value, metric_type: str):
+        if '__name__' in labels:
+            # i.e. a histogram's _bucket, _sum and _count samples
+            labels = dict(labels)
+            name = labels.pop('__name__')
+        if self.tags:
+            labels = dict(self.tags, **labels)
+        line = self.prefix + name
+        if labels and not self.dogstatsd:
+            line += '.' + '.'.join(
+                [str(labels[k]).replace('.', '_') for k in sorted(labels)]
+            )
+        prefix = ''
+        if metric_type == 'g' and value < 0 and not self.dogstatsd:
+            # plain StatsD reads a signed gauge as a change to the stored
+            # value, so set it to zero first; in the same datagram, so the
+            # two can't be reordered
+            prefix = line + ':0|g\n'
+        if isinstance(value, float):
+            line += ':%s|%s' % (value, metric_type)
+        else:
+            line += ':%d|%s' % (value, metric_type)
+        if labels and self.dogstatsd:
+            line += '|#' + ','.join(
+                ['%s:%s' % (k, labels[k]) for k in sorted(labels)]
+            )
+        self._add((prefix + line + '\n').encode())
+
+    def _add(self, line: bytes):
+        n = len(line)
+        if self._len + n > len(self.buf):
+            self.flush()
+            if n > len(self.buf):
+                logger.debug('Dropping StatsD line longer than MTU: %s', line)
+                return
+        self._mv[self._len:self._len + n] = line
+        self._len += n
+
+    def flush(self):
+        """Send the buffered lines, if any."""
+        if not self._len:
+            return
+        try:
+            if self.addr is None:
+                self.addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+            self.sock.sendto(self._mv[:self._len], self.addr)
+            self.packets += 1
+        except Exception as ex:
+            self.errors += 1
+            logger.debug('StatsD send failed: %s', ex)
+        self._len = 0
+
+    def poll(self):
+        """
+        Send pending transitions and, if due, all metric families. Intended
+        to be registered as a microdot idle handler.
+        """
+        if self._pending:
+            self._pending = False
+            for idx, sensor in enumerate(self.sensors):
+                count = self._transitions[idx]
+                if not count:
+                    continue
+                self._transitions[idx] = 0
+                labels = sensor.labels()
+                self._line('gpio_pin_transitions', labels, count, 'c')
+                self._line('gpio_pin_is_on', labels, sensor.input_state, 'g')
+        now = ticks_ms()
+        if ticks_diff(now, self._last_send) >= self.interval_ms:
+            self._last_send = now
+            for name, _, values, _ in self.collect():
+                for labels, value in values:
+                    self._line(name, labels, value, 'g')
+        self.flush()
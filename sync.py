@@ -83,9 +83,22 @@ class BoardSyncer:
             'device_config.py': 'device_config.py',
             'main.py': 'main.py',
             'promdevice.py': 'promdevice.py',
+            'events.py': 'events.py',
+            'eventstream.py': 'eventstream.py',
+            'history.py': 'history.py',
+            'persist.py': 'persist.py',
+            'httpclient.py': 'httpclient.py',
+            'push.py': 'push.py',
+            'mqtt.py': 'mqtt.py',
+            'webhook.py': 'webhook.py',
+            'statsd.py': 'statsd.py',
+            'httpstats.py': 'httpstats.py',
+            'wlanconnect.py': 'wlanconnect.py',
+            'touchsensor.py': 'touchsensor.py',
             'utils.py': 'utils.py',
             'micro-typing.py': 'typing.py',
-            'microdot.py': 'microdot.py'
+            'microdot.py': 'microdot.py',
+            'microdot_asyncio.py': 'microdot_asyncio.py'
         }
         logger.debug('Desired files: %s', desired_files)
         for src, dest in desired_files.items():
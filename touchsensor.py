@@ -0,0 +1,141 @@
+from machine import Pin, TouchPad, Timer
+from typing import List, Optional
+
+from promdevice import Sensor
+from utils import logger
+
+
+class TouchSampler:
+    """
+    Samples every registered ``TouchSensor`` from a single periodic timer
+    callback, so that adding touch pads does not add timers.
+    """
+
+    #: Hardware timer to use for sampling
+    timer_id: int = 0
+
+    #: Sampling period in milliseconds
+    period_ms: int = 100
+
+    def __init__(self):
+        self.sensors: List['TouchSensor'] = []
+        self.timer: Optional[Timer] = None
+
+    def add(self, sensor: 'TouchSensor'):
+        self.sensors.append(sensor)
+        if self.timer is None:
+            logger.debug(
+                'Starting touch sampling timer %d every %dms',
+                self.timer_id, self.period_ms
+            )
+            self.timer = Timer(self.timer_id)
+            self.timer.init(
+                period=self.period_ms, mode=Timer.PERIODIC,
+                callback=self.sample
+            )
+
+    def sample(self, _=None):
+        for sensor in self.sensors:
+            sensor.sample()
+
+    async def run(self):
+        """
+        Sample from an asyncio task instead of the hardware timer, for when
+        the server runs on ``uasyncio`` and can share its event loop.
+        """
+        try:
+            import uasyncio as asyncio
+        except ImportError:
+            import asyncio
+        if self.timer is not None:
+            logger.debug('Moving touch sampling to the event loop')
+            self.timer.deinit()
+            self.timer = None
+        while True:
+            self.sample()
+            await asyncio.sleep(self.period_ms / 1000)
+
+
+#: The sampler shared by all TouchSensors
+sampler: TouchSampler = TouchSampler()
+
+
+class TouchSensor(Sensor):
+
+    metrics = Sensor.metrics + (
+        (
+            'touch_pad_reading', 'Latest raw TouchPad reading.',
+            'reading', 'gauge'
+        ),
+        (
+            'touch_pad_baseline', 'Current untouched TouchPad baseline.',
+            'baseline', 'gauge'
+        ),
+    )
+
+    def __init__(
+        self, name: str, pin_num: int, threshold: int = 100,
+        hysteresis: int = 20, baseline_shift: int = 4, glitch_ms: int = 0,
+        pulse_window: int = 0
+    ):
+        """
+        Defines a single capacitive touch pad that we want to monitor. The pad
+        is read in the background by the shared ``sampler``, and each reading
+        is compared to an exponentially-weighted moving baseline that adapts
+        to slow drift (humidity, temperature) while the pad is not touched.
+
+        :param name: Friendly name of the pad, to use as a prometheus label
+        :param pin_num: GPIO pin number; must be a touch-capable pin
+        :param threshold: How far (in raw ``TouchPad.read()`` counts) a
+          reading must drop below the baseline for the pad to turn on
+        :param hysteresis: How far back above ``baseline - threshold`` a
+          reading must rise for the pad to turn off again
+        :param baseline_shift: The baseline moves ``1 / 2**baseline_shift`` of
+          the way towards each untouched reading
+        :param glitch_ms: Pulses shorter than this many milliseconds are
+          counted as glitches instead of updating the min/max pulse widths
+        :param pulse_window: If non-zero, reset the pulse width and glitch
+          statistics every this many seconds
+        """
+        assert 0 <= hysteresis < threshold, \
+            "hysteresis must be less than threshold"
+        super().__init__(name, glitch_ms=glitch_ms, pulse_window=pulse_window)
+        self.pin_num: int = pin_num
+        self.threshold: int = threshold
+        self.hysteresis: int = hysteresis
+        self.baseline_shift: int = baseline_shift
+        logger.info(
+            'Instantiating TouchSensor "%s" on pin %d (threshold=%d '
+            'hysteresis=%d)', self.name, self.pin_num, self.threshold,
+            self.hysteresis
+        )
+        self.pad: TouchPad = TouchPad(Pin(self.pin_num))
+        self.reading: int = self.pad.read()
+        # baseline scaled up by 2**baseline_shift so that the moving average
+        # keeps its fractional part in integer math
+        self._baseline_acc: int = self.reading << self.baseline_shift
+        self.set_input_off()
+        sampler.add(self)
+
+    @property
+    def baseline(self) -> int:
+        return self._baseline_acc >> self.baseline_shift
+
+    def sample(self):
+        try:
+            reading = self.pad.read()
+        except ValueError:
+            # the ESP32 touch peripheral occasionally fails a read
+            return
+        self.reading = reading
+        drop = self.baseline - reading
+        if self._input_state == 1:
+            if drop < self.threshold - self.hysteresis:
+                self.set_input_off()
+            return
+        if drop >= self.threshold:
+            self.set_input_on()
+            return
+        # only track the baseline while untouched, so that a long touch is
+        # not slowly absorbed into it
+        self._baseline_acc += reading - self.baseline
@@ -1,6 +1,7 @@
 import sys
 import network
 import math
+from time import time_ns
 from typing import Union, List, Tuple, Dict, TYPE_CHECKING
 
 INF = float("inf")
@@ -28,7 +29,9 @@ def prom_metric_str(
     :param help: help/description string for the metric
     :param values: Current values for the metric, as a list of 2-tuples where
       the first item is a dictionary of labels and the second items is the
-      integer or float value.
+      integer or float value. A ``__name__`` label overrides the sample name,
+      i.e. for the ``_bucket``, ``_sum`` and ``_count`` samples of a
+      histogram.
     :param metric_type: Metric type, i.e. gauge
     """
     s = '# HELP ' + name + ' ' + help + '\n' + \
@@ -36,8 +39,9 @@ def prom_metric_str(
     labels: Dict
     value: Union[int, float]
     for labels, value in values:
-        s += name + '{' + ','.join([
+        s += labels.get('__name__', name) + '{' + ','.join([
             f'{k}="{v}"' for k, v in sorted(labels.items())
+            if k != '__name__'
         ]) + '} ' + floatToGoString(value) + '\n'
     return s
 
@@ -54,6 +58,13 @@ def time_to_unix_time(t: Union[int, float]) -> int:
         return int(t)
 
 
+def unix_time_ms() -> int:
+    """
+    Return the current time in integer milliseconds since January 1, 1970.
+    """
+    return time_to_unix_time(0) * 1000 + time_ns() // 1000000
+
+
 def floatToGoString(d) -> str:
     if d == 1:
         return '1.0'
@@ -78,6 +89,37 @@ def floatToGoString(d) -> str:
         return s
 
 
+def server_tls_context(cert: str, key: str):
+    """
+    Return an object with a ``wrap_socket()`` method, for microdot's ``ssl``
+    parameter, that wraps server connections with the given certificate and
+    private key files. This is an ``SSLContext`` where the ``ssl`` module has
+    one, or else a stand-in calling the older ``ssl.wrap_socket()`` function.
+    """
+    import ssl
+    if hasattr(ssl, 'SSLContext'):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(cert, key)
+        return ctx
+    return LegacyTLSContext(cert, key)
+
+
+class LegacyTLSContext:
+    """``SSLContext`` stand-in for MicroPython builds without one"""
+
+    def __init__(self, cert: str, key: str):
+        with open(cert, 'rb') as fh:
+            self.cert: bytes = fh.read()
+        with open(key, 'rb') as fh:
+            self.key: bytes = fh.read()
+
+    def wrap_socket(self, sock, server_side: bool = False):
+        import ssl
+        return ssl.wrap_socket(
+            sock, server_side=server_side, cert=self.cert, key=self.key
+        )
+
+
 class Logger:
     """Stand-in for a real logging library"""
 
@@ -0,0 +1,161 @@
+from time import time, ticks_ms, ticks_diff
+from typing import Dict, List, Optional
+
+from httpclient import HttpClient
+from utils import logger, time_to_unix_time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+class WebhookTarget:
+    """
+    The queue of notifications for one webhook URL, with its connection and
+    retry state, so that a failing URL only holds up its own notifications.
+    """
+
+    def __init__(self, url: str, timeout: float):
+        self.client: HttpClient = HttpClient(url, timeout=timeout)
+        #: Queued notifications, oldest first, as [sensor, time of its
+        #: latest transition]
+        self.queue: List[List] = []
+        #: The notification being sent, if any
+        self.sending: Optional[List] = None
+        self.retries: int = 0
+        self.backoff_ms: int = 0
+        self.last_attempt: int = ticks_ms()
+
+
+class WebhookNotifier:
+    """
+    POSTs a small JSON document to a sensor's ``webhook`` URL whenever it
+    changes state. Transitions (which may be handled inside an IRQ) only add
+    the sensor to its URL's fixed-size queue; requests are sent without
+    blocking from ``poll()``, one at a time per URL. A sensor is queued at
+    most once, and its notification carries its state at the time of
+    sending and the time of its latest transition, so several transitions
+    while waiting or backing off result in one notification with the latest
+    state, and transitions while a request is in flight in one more.
+    """
+
+    def __init__(
+        self, device: str, sensors: List, max_queue: int = 8,
+        max_retries: int = 5, timeout: float = 2
+    ):
+        """
+        :param device: Device name to include in notifications
+        :param sensors: Sensors to watch; only those with a ``webhook`` URL
+          are notified about
+        :param max_queue: Maximum number of queued notifications per URL; the
+          oldest is dropped when full
+        :param max_retries: Consecutive failures after which the notification
+          at the head of a URL's queue is dropped
+        :param timeout: Seconds after which an unanswered request fails
+        """
+        self.device: str = device
+        self.max_queue: int = max_queue
+        self.max_retries: int = max_retries
+        self.targets: Dict[str, WebhookTarget] = {}
+        self.sent: int = 0
+        self.failures: int = 0
+        self.dropped: int = 0
+        for sensor in sensors:
+            if not sensor.webhook:
+                continue
+            if sensor.webhook not in self.targets:
+                self.targets[sensor.webhook] = WebhookTarget(
+                    sensor.webhook, timeout
+                )
+            sensor.listeners.append(self.handle_change)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of notifications waiting to be sent, for all URLs."""
+        return sum([
+            len(t.queue) + (t.sending is not None)
+            for t in self.targets.values()
+        ])
+
+    def adjust_time(self, step: int):
+        """
+        Shift the transition times of queued notifications by ``step``
+        seconds, i.e. when the clock is first set after boot.
+        """
+        for target in self.targets.values():
+            for entry in target.queue:
+                entry[1] += step
+            if target.sending is not None:
+                target.sending[1] += step
+
+    def handle_change(self, sensor):
+        target = self.targets[sensor.webhook]
+        for entry in target.queue:
+            if entry[0] is sensor:
+                entry[1] = time()
+                return
+        if len(target.queue) >= self.max_queue:
+            target.queue.pop(0)
+            self.dropped += 1
+            target.retries = 0
+        target.queue.append([sensor, time()])
+
+    def poll(self):
+        """
+        Advance the request in flight for each URL, or start sending the
+        notification at the head of its queue if not backing off. Intended
+        to be registered as a microdot idle handler.
+        """
+        for target in self.targets.values():
+            try:
+                if target.client.busy:
+                    resp = target.client.poll()
+                    if resp is not None:
+                        self._done(target, *resp)
+                elif target.queue and ticks_diff(
+                    ticks_ms(), target.last_attempt
+                ) >= target.backoff_ms:
+                    target.last_attempt = ticks_ms()
+                    self._send(target)
+            except Exception as ex:
+                self._failed(target, ex)
+
+    def _send(self, target: WebhookTarget):
+        target.sending = target.queue.pop(0)
+        sensor, changed = target.sending
+        body = json.dumps({
+            'device': self.device,
+            'pin_name': sensor.name,
+            'is_on': sensor.input_state,
+            'time': time_to_unix_time(changed)
+        }).encode()
+        target.client.start(
+            'POST', '', body, {'Content-Type': 'application/json'}
+        )
+
+    def _done(self, target: WebhookTarget, status: int, resp: bytes):
+        if status >= 300:
+            raise OSError('HTTP %d: %s' % (status, resp[:100]))
+        target.sending = None
+        self.sent += 1
+        target.retries = 0
+        target.backoff_ms = 0
+
+    def _failed(self, target: WebhookTarget, ex: Exception):
+        self.failures += 1
+        target.retries += 1
+        target.backoff_ms = min(60000, 1000 * 2 ** min(target.retries, 6))
+        logger.debug(
+            'Webhook %s failed (%s); retry in %dms', target.client.host, ex,
+            target.backoff_ms
+        )
+        entry = target.sending
+        target.sending = None
+        if target.retries >= self.max_retries:
+            self.dropped += 1
+            target.retries = 0
+        elif not [e for e in target.queue if e[0] is entry[0]]:
+            # retry it first, unless the sensor has changed again since
+            # and is queued with its newer transition
+            target.queue.insert(0, entry)
@@ -0,0 +1,259 @@
+import os
+import network
+from binascii import hexlify, unhexlify
+from time import ticks_ms, ticks_diff, sleep_ms
+from typing import List, Optional, Tuple
+
+from utils import logger, wlan_status_code
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+class WlanConnector:
+    """
+    Connects the WLAN station interface, remembering the BSSID and channel
+    of the access point it connected to, and the IP configuration it got,
+    in a small file in flash. The next boot connects straight to that access
+    point (and, if ``reuse_ip`` is set, configures the saved address instead
+    of waiting for DHCP); a scan for the strongest access point with the
+    SSID is only done if there is nothing saved or the saved access point
+    can't be reached. The file is only written when the saved details
+    change.
+    """
+
+    #: Path of the saved connection details
+    path: str = 'wlan.json'
+
+    #: Milliseconds to wait for the saved (or scanned) access point before
+    #: falling back to a scan (or to connecting by SSID only)
+    cached_timeout_ms: int = 10000
+
+    def __init__(self, wlan, ssid: str, key: str, reuse_ip: bool = False):
+        """
+        :param wlan: The station ``network.WLAN`` interface
+        :param ssid: SSID to connect to
+        :param key: WPA key
+        :param reuse_ip: Whether to configure the IP address, netmask,
+          gateway and DNS server saved from the last DHCP lease instead of
+          waiting for DHCP when connecting to the saved access point. Only
+          safe if the DHCP server reserves the address for this board.
+        """
+        self.wlan = wlan
+        self.ssid: str = ssid
+        self.key: str = key
+        self.reuse_ip: bool = reuse_ip
+        self.bssid: Optional[bytes] = None
+        self.channel: int = 0
+        self.ifconfig: Optional[Tuple[str, str, str, str]] = None
+        #: How the current connection was made: ``cached`` (saved BSSID),
+        #: ``scan`` (BSSID found by scanning), ``ssid`` (no BSSID) or
+        #: ``existing`` (already connected at boot)
+        self.method: str = 'ssid'
+        #: Milliseconds spent scanning, associating and acquiring an
+        #: address; -1 if that phase has not completed
+        self.scan_ms: int = -1
+        self.association_ms: int = -1
+        self.dhcp_ms: int = -1
+        self._started: int = ticks_ms()
+        self._saved: Optional[Tuple] = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.loads(fh.read())
+            self.bssid = unhexlify(data['bssid'])
+            self.channel = data['channel']
+            self.ifconfig = tuple(data['ifconfig'])
+            self._saved = (self.bssid, self.channel, self.ifconfig)
+        except Exception as ex:
+            logger.debug('No saved WLAN connection details: %s', ex)
+
+    def _save(self):
+        try:
+            channel = self.wlan.config('channel')
+        except Exception:
+            channel = self.channel
+        ifconfig = tuple(self.wlan.ifconfig())
+        self.channel = channel
+        self.ifconfig = ifconfig
+        if self.bssid is None:
+            # the saved access point is unreachable; scan on the next boot
+            # rather than waiting for it again
+            if self._saved is not None:
+                os.remove(self.path)
+                self._saved = None
+            return
+        if (self.bssid, channel, ifconfig) == self._saved:
+            return
+        self._saved = (self.bssid, channel, ifconfig)
+        with open(self.path, 'w') as fh:
+            fh.write(json.dumps({
+                'bssid': hexlify(self.bssid).decode(),
+                'channel': channel,
+                'ifconfig': list(ifconfig)
+            }))
+        logger.debug('Saved WLAN connection details to %s', self.path)
+
+    def start(self):
+        """
+        Activate the interface and start connecting, without waiting for the
+        connection. Scans first if there is no saved access point.
+        """
+        self.wlan.active(True)
+        if self.wlan.isconnected():
+            self.method = 'existing'
+            self.association_ms = 0
+            self.dhcp_ms = 0
+            return
+        if self.bssid is None:
+            self._scan()
+        else:
+            self.method = 'cached'
+            if self.reuse_ip and self.ifconfig:
+                self.wlan.ifconfig(self.ifconfig)
+        self._connect()
+
+    def _scan(self):
+        started = ticks_ms()
+        best: Optional[Tuple] = None
+        try:
+            found: List[Tuple] = self.wlan.scan()
+        except Exception as ex:
+            logger.debug('WLAN scan failed: %s', ex)
+            found = []
+        for ap in found:
+            # (ssid, bssid, channel, RSSI, security, hidden)
+            if ap[0].decode() != self.ssid:
+                continue
+            if best is None or ap[3] > best[3]:
+                best = ap
+        self.scan_ms = ticks_diff(ticks_ms(), started)
+        if best is None:
+            logger.debug('SSID not found in scan; connecting without BSSID')
+            self.method = 'ssid'
+            self.bssid = None
+            return
+        self.method = 'scan'
+        self.bssid = best[1]
+        self.channel = best[2]
+        logger.debug(
+            'Strongest access point: %s on channel %d (RSSI %d)',
+            hexlify(self.bssid).decode(), self.channel, best[3]
+        )
+
+    def _connect(self):
+        logger.debug('connecting to network (%s)...', self.method)
+        self._started = ticks_ms()
+        if self.bssid is None:
+            self.wlan.connect(self.ssid, self.key)
+        else:
+            self.wlan.connect(self.ssid, self.key, bssid=self.bssid)
+
+    def _fall_back(self):
+        logger.debug(
+            'Could not connect to access point %s (%s)',
+            hexlify(self.bssid).decode(), self.method
+        )
+        self.wlan.disconnect()
+        self.association_ms = -1
+        if self.method == 'cached':
+            if self.reuse_ip and self.ifconfig:
+                try:
+                    self.wlan.ifconfig('dhcp')
+                except Exception as ex:
+                    logger.debug('Could not re-enable DHCP: %s', ex)
+            self._scan()
+        else:
+            # let the driver pick any access point with the SSID
+            self.method = 'ssid'
+            self.bssid = None
+        self._connect()
+
+    def _associated(self) -> bool:
+        """
+        Whether the interface is associated with an access point. On ESP32,
+        ``isconnected()`` only turns true once an address has been acquired,
+        but the access point's RSSI can be read as soon as it is associated.
+        """
+        try:
+            self.wlan.status('rssi')
+            return True
+        except Exception:
+            return self.wlan.isconnected()
+
+    def wait(self, timeout_ms: int = 60000) -> bool:
+        """
+        Wait until the interface is associated and has an IP address,
+        falling back to a scan if the saved access point can't be reached
+        within ``cached_timeout_ms``, and then to connecting by SSID only if
+        the access point found by the scan can't be reached either. Saves
+        the connection details on success.
+
+        :param timeout_ms: Milliseconds to wait in total
+        :return: Whether the interface is connected
+        """
+        started = ticks_ms()
+        polls = 0
+        while self.dhcp_ms < 0:
+            now = ticks_ms()
+            elapsed = ticks_diff(now, self._started)
+            if self.association_ms < 0 and self._associated():
+                self.association_ms = elapsed
+            if self.association_ms >= 0:
+                if self.wlan.ifconfig()[0] != '0.0.0.0':
+                    self.dhcp_ms = elapsed - self.association_ms
+                    break
+            elif self.bssid is not None and (
+                elapsed > self.cached_timeout_ms or
+                self.wlan.status() == network.STAT_NO_AP_FOUND
+            ):
+                self._fall_back()
+            if ticks_diff(now, started) > timeout_ms:
+                return False
+            if polls % 50 == 0:
+                stat = self.wlan.status()
+                logger.debug(
+                    'WLAN is not connected; status=%s',
+                    wlan_status_code.get(stat, stat)
+                )
+            polls += 1
+            sleep_ms(20)
+        logger.debug(
+            'WLAN connected (%s); association %dms, DHCP %dms',
+            self.method, self.association_ms, self.dhcp_ms
+        )
+        if self.method != 'existing':
+            self._save()
+        return True
+
+    def metric_families(self) -> List[Tuple]:
+        phases = (
+            ('scan', self.scan_ms), ('association', self.association_ms),
+            ('dhcp', self.dhcp_ms)
+        )
+        return [
+            (
+                'esp_wlan_connect_seconds',
+                'Seconds spent in each phase of connecting the WLAN at boot.',
+                [
+                    ({'phase': phase}, ms / 1000)
+                    for phase, ms in phases if ms >= 0
+                ], 'gauge'
+            ),
+            (
+                'esp_wlan_connect_info',
+                'How the WLAN was connected at boot: via the saved access '
+                'point (cached), one found by scanning (scan), by SSID only '
+                '(ssid) or already connected (existing).',
+                [({
+                    'method': self.method,
+                    'bssid': hexlify(self.bssid).decode() if self.bssid
+                    else '',
+                    'channel': str(self.channel)
+                }, 1)], 'gauge'
+            ),
+        ]